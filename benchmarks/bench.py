@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+import tracemalloc
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Los módulos del proyecto viven en la raíz del repositorio
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,RAIZ)
+
+import closest_point
+import closest_point_google
+from denue_cache import cargar_denue
+from google_client import DistanceMatrixClient
+from distance_matrix_stub import inicia_stub
+from servidor import inicia_servidor
+from sintetico import genera_denue, genera_manzanas
+
+
+def mide(funcion,repeticiones:int=1)->dict:
+    '''
+    Corre la función `repeticiones` veces y devuelve los tiempos (segundos) y la memoria pico
+    (MB, asignaciones de Python y NumPy vistas por tracemalloc) de la corrida más cara
+    '''
+    tiempos, pico = [], 0
+    for _ in range(repeticiones):
+        tracemalloc.start()
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append(time.perf_counter()-inicio)
+        pico = max(pico,tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {'segundos':float(np.median(tiempos)),'segundos_min':float(np.min(tiempos)),
+            'repeticiones':repeticiones,'memoria_pico_mb':pico/2**20}
+
+
+def latencias(funcion,n:int)->dict:
+    '''
+    Percentiles (milisegundos) de llamar la función n veces, una consulta por llamada
+    '''
+    tiempos = []
+    for i in range(n):
+        inicio = time.perf_counter()
+        funcion(i)
+        tiempos.append((time.perf_counter()-inicio)*1000)
+    return {'p50_ms':float(np.percentile(tiempos,50)),'p90_ms':float(np.percentile(tiempos,90)),
+            'p99_ms':float(np.percentile(tiempos,99)),'consultas':n}
+
+
+def entorno()->dict:
+    '''
+    Versión del código y del entorno para comparar corridas
+    '''
+    try:
+        commit = subprocess.run(['git','rev-parse','--short','HEAD'],cwd=RAIZ,capture_output=True,
+                                text=True,check=True).stdout.strip()
+    except (OSError,subprocess.CalledProcessError):
+        commit = None
+    import scipy, pandas
+    return {'commit':commit,'python':platform.python_version(),'numpy':np.__version__,
+            'scipy':scipy.__version__,'pandas':pandas.__version__,'maquina':platform.machine(),
+            'cpus':os.cpu_count(),'fecha':time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def corre(args)->list:
+    directorio = args.directorio or tempfile.mkdtemp(prefix='bench_denue_')
+    os.makedirs(directorio,exist_ok=True)
+    path_shp = os.path.join(directorio,f'denue_{args.unidades}.shp')
+    cache_dir = os.path.join(directorio,'cache')
+    configuracion = {'unidades':args.unidades,'puntos':args.puntos,'clusters':args.clusters,
+                     'semilla':args.semilla,'metros':args.metros,'k':args.k}
+    resultados = []
+
+    def registra(nombre:str,medida:dict,**extra):
+        fila = dict(benchmark=nombre,**dict(configuracion,**extra),**medida)
+        resultados.append(fila)
+        print(json.dumps(fila),file=sys.stderr)
+
+    # Datos sintéticos
+    registra('genera_denue',mide(lambda: genera_denue(path_shp,args.unidades,semilla=args.semilla,clusters=args.clusters)))
+    manzanas = genera_manzanas(args.puntos,semilla=args.semilla+1,clusters=args.clusters)
+    lat, lon = manzanas['latitud'].values, manzanas['longitud'].values
+    codigos = {'462111':'supermercados','462112':'minisupers','722511':'restaurantes'}
+
+    # Carga: shapefile a cache (frío) y cache memory-mapped (caliente)
+    shutil.rmtree(cache_dir,ignore_errors=True)
+    registra('carga_fria',mide(lambda: cargar_denue(path_shp,cache_dir=cache_dir)))
+    registra('carga_cache',mide(lambda: cargar_denue(path_shp,cache_dir=cache_dir),args.repeticiones))
+    store = cargar_denue(path_shp,cache_dir=cache_dir)
+
+    # RadiousUnidadesEconomicas: lote completo (incluye construir los árboles la primera vez)
+    def rue():
+        return closest_point.RadiousUnidadesEconomicas(path_shp_denue=store,codigo_act_dict=codigos,
+                                                       lat=lat,lon=lon,metros=args.metros,k=args.k)
+    medida = mide(rue)
+    registra('radious_lote_primera',medida,puntos_por_segundo=args.puntos/medida['segundos'])
+    medida = mide(rue,args.repeticiones)
+    registra('radious_lote',medida,puntos_por_segundo=args.puntos/medida['segundos'])
+    if args.n_jobs!=1:
+        medida = mide(lambda: closest_point.RadiousUnidadesEconomicas(path_shp_denue=store,codigo_act_dict=codigos,
+                                                                       lat=lat,lon=lon,metros=args.metros,k=args.k,
+                                                                       n_jobs=args.n_jobs))
+        registra('radious_lote_paralelo',medida,puntos_por_segundo=args.puntos/medida['segundos'],n_jobs=args.n_jobs)
+
+    # Latencia de una sola manzana por llamada
+    n = min(args.consultas,args.puntos)
+    registra('radious_latencia',latencias(lambda i: closest_point.RadiousUnidadesEconomicas(
+        path_shp_denue=store,codigo_act_dict=codigos,lat=lat[i],lon=lon[i],metros=args.metros,k=args.k),n))
+
+    # RadiousKeyWord (la primera vez construye el índice de nombres)
+    palabras = ['oxxo','super','farmacia']
+    def rkw():
+        return closest_point.RadiousKeyWord(path_shp_denue=store,key_words_list=palabras,lat=lat,lon=lon,
+                                            metros=args.metros,k=args.k)
+    medida = mide(rkw)
+    registra('keyword_lote_primera',medida,puntos_por_segundo=args.puntos/medida['segundos'])
+    medida = mide(rkw,args.repeticiones)
+    registra('keyword_lote',medida,puntos_por_segundo=args.puntos/medida['segundos'])
+
+    # Servidor con el índice caliente: clientes concurrentes de una manzana por solicitud
+    if args.clientes:
+        server, url = inicia_servidor({'sintetico':store},espera_ms=args.espera_ms)
+        def solicitud(i):
+            cuerpo = json.dumps({'estado':'sintetico','codigo_act_dict':codigos,'lat':[lat[i]],'lon':[lon[i]],
+                                 'metros':args.metros,'k':args.k}).encode('utf-8')
+            peticion = urllib.request.Request(url+'/consulta',data=cuerpo,headers={'Content-Type':'application/json'})
+            inicio = time.perf_counter()
+            with urllib.request.urlopen(peticion) as r:
+                r.read()
+            return (time.perf_counter()-inicio)*1000
+        try:
+            n = min(args.consultas*args.clientes,args.puntos)
+            inicio = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.clientes) as pool:
+                tiempos = list(pool.map(solicitud,range(n)))
+            segundos = time.perf_counter()-inicio
+            registra('servidor',{'p50_ms':float(np.percentile(tiempos,50)),'p90_ms':float(np.percentile(tiempos,90)),
+                                 'p99_ms':float(np.percentile(tiempos,99)),'consultas':n,'segundos':segundos},
+                     consultas_por_segundo=n/segundos,clientes=args.clientes,espera_ms=args.espera_ms,
+                     lotes=server.lotes.lotes,puntos_por_lote=n/max(server.lotes.lotes,1))
+        finally:
+            server.shutdown()
+
+    # Ruta de Google contra el stub local (sin llave ni red; un solo radio)
+    if args.google_puntos:
+        server, url = inicia_stub()
+        m = min(args.google_puntos,args.puntos)
+        try:
+            with DistanceMatrixClient('stub',url=url,hilos=args.hilos) as cliente:
+                medida = mide(lambda: closest_point_google.RadiousUnidadesEconomicas(
+                    path_shp_denue=store,codigo_act_dict={'462111':'supermercados'},lat=lat[:m],lon=lon[:m],
+                    metros=max(args.metros),google=True,cliente=cliente))
+            registra('google_stub',medida,puntos_por_segundo=m/medida['segundos'],puntos=m,
+                     solicitudes=server.solicitudes,elementos=server.elementos)
+        finally:
+            server.shutdown()
+
+    if args.directorio is None:
+        shutil.rmtree(directorio,ignore_errors=True)
+    return resultados
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks con un DENUE sintético')
+    parser.add_argument('--unidades',type=int,default=100000,help='unidades del DENUE sintético')
+    parser.add_argument('--puntos',type=int,default=10000,help='manzanas a consultar')
+    parser.add_argument('--clusters',type=int,default=20,help='agrupaciones de unidades y manzanas (0 uniforme)')
+    parser.add_argument('--metros',type=float,nargs='+',default=[500,1000,2000])
+    parser.add_argument('--k',type=int,default=3)
+    parser.add_argument('--consultas',type=int,default=200,help='llamadas de una manzana para la latencia')
+    parser.add_argument('--repeticiones',type=int,default=3)
+    parser.add_argument('--n_jobs',type=int,default=1)
+    parser.add_argument('--clientes',type=int,default=8,help='clientes concurrentes del servidor (0 lo omite)')
+    parser.add_argument('--espera_ms',type=float,default=5,help='espera del micro-lote del servidor')
+    parser.add_argument('--google_puntos',type=int,default=200,help='manzanas para la ruta de Google (0 la omite)')
+    parser.add_argument('--hilos',type=int,default=8)
+    parser.add_argument('--semilla',type=int,default=0)
+    parser.add_argument('--directorio',help='donde dejar el shapefile y el cache (por omisión uno temporal)')
+    parser.add_argument('--salida',help='archivo json con los resultados (por omisión a la salida estándar)')
+    args = parser.parse_args()
+
+    reporte = {'entorno':entorno(),'resultados':corre(args)}
+    if args.salida:
+        with open(args.salida,'w') as f:
+            json.dump(reporte,f,indent=1)
+    else:
+        print(json.dumps(reporte,indent=1))
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd # Para leer y manipular shapefiles
+
+
+# Códigos de actividad y su peso relativo en el DENUE sintético
+CODIGOS = {'462111':0.02,'462112':0.20,'461110':0.25,'722511':0.15,'722515':0.08,
+           '611121':0.03,'522110':0.02,'622111':0.01,'463211':0.14,'721111':0.10}
+# Palabras para armar nombres de establecimientos
+PALABRAS = ['ABARROTES','SUPER','TIENDA','OXXO','SORIANA','CAFÉ','TACOS','FARMACIA','LA','EL',
+            'DON','DOÑA','SAN','JOSÉ','MARÍA','GUADALUPE','PUNTA','ESQUINA','CENTRO','NORTE']
+
+
+def coordenadas(n:int,centro=(21.0,-89.6),extension_km:float=30,clusters:int=20,
+                dispersion_km:float=1.5,fraccion_uniforme:float=0.2,semilla:int=0):
+    '''
+    Coordenadas sintéticas: una parte uniforme en un cuadrado alrededor del centro y el resto
+    agrupado alrededor de `clusters` centros (como las colonias comerciales de una ciudad)
+    ----------
+    Inputs:
+            - n: int, número de puntos
+            - centro: tuple, (latitud, longitud) del centro
+            - extension_km: float, medio lado del cuadrado
+            - clusters: int, número de agrupaciones (0 es todo uniforme)
+            - dispersion_km: float, desviación estándar de cada agrupación
+            - fraccion_uniforme: float, fracción de puntos sin agrupar
+            - semilla: int, semilla del generador
+    Outputs:
+            - (latitud, longitud): arrays
+    '''
+    rng = np.random.default_rng(semilla)
+    km_lat = 1/111.32
+    km_lon = km_lat/np.cos(np.radians(centro[0]))
+    uniformes = n if clusters==0 else int(round(n*fraccion_uniforme))
+    lat = centro[0]+rng.uniform(-extension_km,extension_km,n)*km_lat
+    lon = centro[1]+rng.uniform(-extension_km,extension_km,n)*km_lon
+    if uniformes<n:
+        centros_lat = centro[0]+rng.uniform(-extension_km,extension_km,clusters)*km_lat
+        centros_lon = centro[1]+rng.uniform(-extension_km,extension_km,clusters)*km_lon
+        c = rng.integers(0,clusters,n-uniformes)
+        lat[uniformes:] = centros_lat[c]+rng.normal(0,dispersion_km,n-uniformes)*km_lat
+        lon[uniformes:] = centros_lon[c]+rng.normal(0,dispersion_km,n-uniformes)*km_lon
+    return lat, lon
+
+
+def genera_denue(path_shp:str,n:int,semilla:int=0,**opciones)->gpd.GeoDataFrame:
+    '''
+    Escribe un shapefile con la estructura del DENUE (id, nom_estab, codigo_act, latitud,
+    longitud y la geometría en EPSG:4326) con n unidades sintéticas
+    ----------
+    Inputs:
+            - path_shp: str, path del shapefile a escribir
+            - n: int, número de unidades
+            - semilla: int, semilla del generador
+            - opciones: argumentos de coordenadas (centro, extension_km, clusters, ...)
+    Outputs:
+            - GeoDataFrame escrito
+    '''
+    rng = np.random.default_rng(semilla+1)
+    lat, lon = coordenadas(n,semilla=semilla,**opciones)
+    codigos = np.array(list(CODIGOS))
+    pesos = np.array(list(CODIGOS.values()))
+    nombres = [' '.join(p) for p in rng.choice(PALABRAS,(n,3))]
+    denue = gpd.GeoDataFrame({'id':np.arange(1,n+1),
+                              'nom_estab':nombres,
+                              'codigo_act':rng.choice(codigos,n,p=pesos/pesos.sum()),
+                              'latitud':lat,
+                              'longitud':lon},
+                             geometry=gpd.points_from_xy(lon,lat),crs='EPSG:4326')
+    denue.to_file(path_shp)
+    return denue
+
+
+def genera_manzanas(n:int,semilla:int=1,**opciones)->pd.DataFrame:
+    '''
+    Centroides sintéticos de manzanas (CVEGEO, latitud, longitud) como los de denue_cache.cargar_manzanas
+    '''
+    lat, lon = coordenadas(n,semilla=semilla,**opciones)
+    return pd.DataFrame({'CVEGEO':[f'31{i:014d}' for i in range(n)],'latitud':lat,'longitud':lon})
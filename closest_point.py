@@ -1,196 +1,193 @@
 import numpy as np
 import pandas as pd
-import requests # Para acceder a la APIs
-import re # Para usar regular expressions
-import geopandas as gpd # Para leer y manipular shapefiles
-from shapely.geometry import Point # Para crear un punto con latitud y longitud
-import yaml # Para leer datos como keys y paths
 import time
-from tabulate import tabulate
+from denue_index import a_arreglo
+from denue_store import DenueStore
+from denue_cache import como_store
+from distancias import conteos_y_vecinos
+from paralelo import consulta_paralela
+from keyword_index import nombre_columna
+from metricas import etapa, cuenta
 
 
-def RadiousUnidadesEconomicas(*,path_shp_denue:str,codigo_act_dict:dict,lat:[float,list],lon:[float,list],metros=2000):
+def _agrega_columnas(df:pd.DataFrame,nombre:str,numero:np.ndarray,distancia:np.ndarray,metros,k:int):
+    '''
+    Agrega al DataFrame las columnas de número de unidades y distancia. Con un solo radio y k=1
+    son nombre_numero y nombre_distancia; con una lista de radios hay una columna
+    nombre_numero_<metros> por radio y con k>1 nombre_distancia_1..nombre_distancia_k.
+    '''
+    if np.ndim(metros)==0:
+        df[nombre+'_numero'] = numero[:,0]
+    else:
+        for r, m in enumerate(metros):
+            m = int(m) if float(m).is_integer() else m
+            df[f'{nombre}_numero_{m}'] = numero[:,r]
+
+    if k==1:
+        df[nombre+'_distancia'] = np.round(distancia[:,0],2)
+    else:
+        for j in range(k):
+            df[f'{nombre}_distancia_{j+1}'] = np.round(distancia[:,j],2)
+
+
+def RadiousUnidadesEconomicas(*,path_shp_denue:[str,DenueStore],codigo_act_dict:dict,lat:[float,list],lon:[float,list],metros=2000,k=1,motor='kdtree',memoria_mb=256,n_jobs=1,bloque_puntos=None,metrica='haversine',
+                              grid=None,exacto=False):
     '''
     A partir de un radio fijo cuenta el número de unidades económicas del código especificado
     y la mínima distancia lineal al punto (posiblemente fuera de la circunferencia)
     Si no hay unidades devuelve NaN en la distancia. 
     ----------
     Inputs: 
-            - path_shp_denue_estado: str, path al shapefile de la denue, de preferencia de un estado específico
+            - path_shp_denue_estado: str, path al shapefile de la denue, de preferencia de un estado específico,
+              o un DenueStore ya cargado para no volver a leer el shapefile, o un DenueNacional
+              (ver denue_nacional.py) para buscar en todo el país cruzando fronteras entre estados
             - codigo_act_dict: dict, código de 6 dígitos del DENUE, key=clave y value=nombre
             - lat: list o float, latitudes 
             - lon: list o float, longitudes 
-            - metros: float, metros a buscar
+            - metros: float o list, metros a buscar; con una lista se cuenta en todos los radios en una sola pasada
+            - k: int, número de unidades más cercanas de las que se da la distancia
+            - motor: str, 'kdtree' (índice espacial) o 'numpy' (matriz de distancias por bloques)
+            - memoria_mb: float, memoria máxima de cada bloque de la matriz cuando motor='numpy'
+            - n_jobs: int, procesos para repartir códigos y bloques de puntos (1 sin pool, -1 todos los cores)
+            - bloque_puntos: int, puntos por tarea cuando n_jobs!=1
+            - metrica: str, 'haversine' (distancia sobre la esfera), 'proyectada' (UTM del estado)
+              o 'grados' (la aproximación original con alpha), ver distancias.Metrica
+            - grid: GridDensidad, tabla precalculada del estado (ver grid_density); responde desde la celda
+              de cada punto y sólo se calculan exactos los puntos o códigos que no cubre
+            - exacto: boole, ignora el grid y calcula todo con precisión completa
     Outputs: 
-            - DataFrame con duración mínima y número de unidades 
+            - DataFrame con duración mínima y número de unidades (ver _agrega_columnas para los nombres
+              de las columnas con varios radios o k>1)
     '''
 
-    # Cargamos el shapefile del DENUE 
-    denue = gpd.read_file(path_shp_denue)
-
     # Convertimos en lista el código de actividad
     codigo_act = list(codigo_act_dict.keys())
     
-    # Ver si lat,lon son iterables, sino crea una lista
-     if isinstance(lat,str): 
-        lat = float(lat)
-    
-    if isinstance(lon,str): 
-        lon = float(lon)
-
-    try: 
-        for i,x in enumerate(lat): 
-            lat[i] = float(x)
-    except: 
-        lat = [lat]
-
-    try: 
-       for i,x in enumerate(lon): 
-            lon[i] = float(x)
-    except: 
-        lon = [lon]
+    # Convertimos lat,lon en arreglos (acepta float, str, lista o Series)
+    lat = a_arreglo(lat)
+    lon = a_arreglo(lon)
+    cuenta('puntos',len(lat))
+
+    # Con la tabla precalculada respondemos desde la celda de cada punto; anotamos qué puntos
+    # de cada código (fuera de la malla, o todos si la tabla no lo cubre) hay que calcular exactos
+    resultados = {}
+    pendientes = {}
+    for codigo in codigo_act:
+        if grid is not None and not exacto and grid.cubre(codigo,metros,k,metrica):
+            with etapa('consulta_grid'):
+                numero, distancia, dentro = grid.consulta(codigo,lat,lon,metros)
+            cuenta('puntos_grid',int(dentro.sum()))
+            resultados[codigo] = (numero,distancia)
+            if not dentro.all():
+                pendientes[codigo] = ~dentro
+        else:
+            pendientes[codigo] = np.ones(len(lat),dtype=bool)
+
+    if pendientes:
+        # Cargamos el DENUE (sólo si nos dan un path) con su índice espacial (un KD-tree por código)
+        with etapa('carga_denue'):
+            store = como_store(path_shp_denue)
+        # Cada código se calcula sólo en sus puntos pendientes; los códigos con los mismos
+        # puntos pendientes (p.ej. todos los que no cubre el grid) van juntos
+        grupos = {}
+        for codigo, exactos in pendientes.items():
+            cuenta('puntos_exactos',int(exactos.sum()))
+            grupos.setdefault(exactos.tobytes(),(exactos,[]))[1].append(codigo)
+
+        # Contamos las unidades en los radios y las distancias a las k más cercanas para todos los
+        # puntos a la vez (si no hay esta unidad en el estado devuelve 0's y NaN's).
+        # Con n_jobs!=1 repartimos códigos y bloques de puntos en un pool de procesos
+        for exactos, codigos in grupos.values():
+            with etapa('consulta_indice'):
+                if n_jobs!=1:
+                    calculados = consulta_paralela(store,codigos,lat[exactos],lon[exactos],metros,k=k,n_jobs=n_jobs,
+                                                   bloque_puntos=bloque_puntos,motor=motor,memoria_mb=memoria_mb,metrica=metrica)
+                else:
+                    calculados = {codigo:store.consulta_multiple(codigo,lat[exactos],lon[exactos],metros,k=k,motor=motor,
+                                                                 memoria_mb=memoria_mb,metrica=metrica)
+                                  for codigo in codigos}
+
+            for codigo, (numero,distancia) in calculados.items():
+                if codigo in resultados:
+                    resultados[codigo][0][exactos] = numero
+                    resultados[codigo][1][exactos] = distancia
+                else:
+                    resultados[codigo] = (numero,distancia)
 
     # DataFrame de resultados
     df = pd.DataFrame()
 
     for codigo in codigo_act: 
         actividad = codigo_act_dict[codigo]
-        # Filtramos el DENUE con código de actividad 
-        denue_codigo = denue[denue['codigo_act']==codigo].copy()
-
-        # Si no hay esta unidad en el estado devolvemos 0's y NaN's
-        if len(denue_codigo)==0:
-            numero_unidades_radius = [0 for _ in range(len(lat))]
-            distance = [np.nan for _ in range(len(lat))]
-
-        else: 
-            # Cambiamos el sistema de coordenadas
-            denue_codigo.to_crs("EPSG:4326",inplace=True)
-
-            numero_unidades_radius = []
-            distance = []
-            for Lat,Lon in zip(lat,lon):
-                # Creamos un punto el la coordenada proporcionada
-                pt = gpd.GeoSeries([Point(Lon,Lat)])
-
-                # alpha es una constante para traducir metros en el crs especificado
-                alpha = 0.005/550
-                # Creamos la circunferencia con los metros especificados
-                circle = pt.buffer(metros*alpha)
-                # Convertimos el punto en un GeoDataFrame 
-                circle = gpd.GeoDataFrame(circle,columns=['geometry'])
-                # Cambiamos el sistema de coordenadas para que coicidan
-                circle.set_crs("EPSG:4326",inplace=True)
-                # Obtenemos la base con las intersecciones geográficas (puntos que caen en la circunferencia)
-                inter = gpd.overlay(denue_codigo, circle, how='intersection')
-                # El número de unidades al rededor del punto es len(inter)
-                numero_unidades_radius.append(len(inter))
-
-                # Calculamos la distancia euclediana 
-                denue_codigo['distance_to_point'] = denue_codigo['geometry'].apply(lambda p: np.sqrt((p.x-pt.x)**2+(p.y-pt.y)**2)/alpha)
-                # Ordenamos por la distancia de menor a mayor
-                denue_codigo = denue_codigo.sort_values(by='distance_to_point',ascending=True)
-                denue_codigo.reset_index(drop=True,inplace=True)
-                # Nos quedamos con la distancia lineal más pequeña
-                distance.append(np.round(denue_codigo.loc[0,'distance_to_point'],2))
-        
-            # Devolvemos el número de unidades y la duración mínima
-            df.loc[:,actividad+'_numero'] = numero_unidades_radius
-            df.loc[:,actividad+'_distancia'] = distance
+        numero_unidades_radius, distance = resultados[codigo]
+
+        # Devolvemos el número de unidades y las distancias mínimas
+        _agrega_columnas(df,actividad,numero_unidades_radius,distance,metros,k)
 
     return df
 
 
-def RadiousKeyWord(*,path_shp_denue:str,key_words_list:list,lat:[float,list],lon:[float,list],metros=2000):
+def RadiousKeyWord(*,path_shp_denue:[str,DenueStore],key_words_list:[list,dict],lat:[float,list],lon:[float,list],metros=2000,k=1,memoria_mb=256,metrica='haversine'):
     '''
     A partir de un radio fijo cuenta el número de unidades económicas con la palabra clave especificada
     y la mínima distancia lineal al punto (posiblemente fuera de la circunferencia)
     Si no hay unidades devuelve NaN en la distancia. 
     ----------
     Inputs: 
-            - path_shp_denue_estado: str, path al shapefile de la denue, de preferencia de un estado específico
-            - key_words_list: list, palabras clave sobre el nombre del establecimiento
+            - path_shp_denue_estado: str, path al shapefile de la denue, de preferencia de un estado específico,
+              o un DenueStore ya cargado para no volver a leer el shapefile
+            - key_words_list: list, palabras clave sobre el nombre del establecimiento (sin importar
+              mayúsculas ni acentos), o dict key=palabra clave y value=nombre de la columna
             - lat: list o float, latitudes 
             - lon: list o float, longitudes 
-            - metros: float, metros a buscar
+            - metros: float o list, metros a buscar
+            - k: int, número de unidades más cercanas de las que se da la distancia
+            - memoria_mb: float, memoria máxima de cada bloque de la matriz de distancias
+            - metrica: str, 'haversine', 'proyectada' o 'grados' (ver distancias.Metrica)
     Outputs: 
-            - DataFrame con duración mínima y número de unidades 
+            - DataFrame con duración mínima y número de unidades, las columnas de una palabra
+              sin nombre en el dict son la palabra normalizada (p.ej. 'Café Punta' -> 'cafe_punta_numero')
     '''
 
-    # Cargamos el shapefile del DENUE 
-    denue = gpd.read_file(path_shp_denue)
+    # Cargamos el DENUE (sólo si nos dan un path)
+    with etapa('carga_denue'):
+        store = como_store(path_shp_denue)
 
-    # Convertimos en lista las palabras clave 
-    if isinstance(key_words_list, list):
+    # Convertimos en dict palabra clave: nombre de la columna
+    if isinstance(key_words_list, dict):
         pass 
+    elif isinstance(key_words_list, list):
+        key_words_list = {k:nombre_columna(k) for k in key_words_list}
     else: 
-        key_words_list = [key_words_list] 
+        key_words_list = {key_words_list:nombre_columna(key_words_list)} 
     
-    # Ver si lat,lon son iterables, sino crea una lista
-    if isinstance(lat,str): 
-        lat = float(lat)
-    
-    if isinstance(lon,str): 
-        lon = float(lon)
-
-    try: 
-        for i,x in enumerate(lat): 
-            lat[i] = float(x)
-    except: 
-        lat = [lat]
-
-    try: 
-       for i,x in enumerate(lon): 
-            lon[i] = float(x)
-    except: 
-        lon = [lon]
+    # Convertimos lat,lon en arreglos (acepta float, str, lista o Series)
+    lat = a_arreglo(lat)
+    lon = a_arreglo(lon)
+    metrica = store.indice.metrica(metrica)
+    puntos = metrica.coordenadas(lat,lon)
+    cuenta('puntos',len(lat))
 
     # DataFrame de resultados
     df = pd.DataFrame()
 
-    for k in key_words_list: 
+    # Buscamos las palabras en el índice invertido de los nombres
+    with etapa('busca_nombre'):
+        posiciones = store.indice_nombres.busca_varias(list(key_words_list))
+
+    for palabra, nombre in key_words_list.items(): 
         # Filtramos el DENUE con el nombre clave 
-        k = k.strip().upper()
-        denue_codigo = denue[denue['nom_estab'].str.contains(k)].copy()
-
-        # Si no hay esta unidad en el estado devolvemos 0's y NaN's
-        if len(denue_codigo)==0:
-            numero_unidades_radius = [0 for _ in range(len(lat))]
-            distance = [np.nan for _ in range(len(lat))]
-        else: 
-            # Cambiamos el sistema de coordenadas
-            denue_codigo.to_crs("EPSG:4326",inplace=True)
-
-            numero_unidades_radius = []
-            distance = []
-            for Lat,Lon in zip(lat,lon):
-                # Creamos un punto el la coordenada proporcionada
-                pt = gpd.GeoSeries([Point(Lon,Lat)])
-
-                # alpha es una constante para traducir metros en el crs especificado
-                alpha = 0.005/550
-                # Creamos la circunferencia con los metros especificados
-                circle = pt.buffer(metros*alpha)
-                # Convertimos el punto en un GeoDataFrame 
-                circle = gpd.GeoDataFrame(circle,columns=['geometry'])
-                # Cambiamos el sistema de coordenadas para que coicidan
-                circle.set_crs("EPSG:4326",inplace=True)
-                # Obtenemos la base con las intersecciones geográficas (puntos que caen en la circunferencia)
-                inter = gpd.overlay(denue_codigo, circle, how='intersection')
-                # El número de unidades al rededor del punto es len(inter)
-                numero_unidades_radius.append(len(inter))
-
-                # Calculamos la distancia euclediana 
-                denue_codigo['distance_to_point'] = denue_codigo['geometry'].apply(lambda p: np.sqrt((p.x-pt.x)**2+(p.y-pt.y)**2)/alpha)
-                # Ordenamos por la distancia de menor a mayor
-                denue_codigo = denue_codigo.sort_values(by='distance_to_point',ascending=True)
-                denue_codigo.reset_index(drop=True,inplace=True)
-                # Nos quedamos con la distancia lineal más pequeña
-                distance.append(np.round(denue_codigo.loc[0,'distance_to_point'],2))
-        
-            # Devolvemos el número de unidades y la duración mínima
-            df.loc[:,actividad+'_numero'] = numero_unidades_radius
-            df.loc[:,actividad+'_distancia'] = distance
+        unidades = store.coordenadas(posiciones[palabra],metrica)
+        cuenta('unidades_candidatas',len(unidades))
+
+        # Contamos las unidades en el radio y la distancia mínima para todos los puntos a la vez
+        # (si no hay unidades con la palabra clave devuelve 0's y NaN's)
+        radios = [metrica.radio(r) for r in np.atleast_1d(metros)]
+        with etapa('consulta_numpy'):
+            numero_unidades_radius, distance = conteos_y_vecinos(puntos,unidades,radios,k,memoria_mb)
+
+        # Devolvemos el número de unidades y la duración mínima
+        _agrega_columnas(df,nombre,numero_unidades_radius,metrica.a_metros(distance),metros,k)
 
     return df
 
@@ -198,6 +195,9 @@ def RadiousKeyWord(*,path_shp_denue:str,key_words_list:list,lat:[float,list],lon
 
 
 if __name__=='__main__':
+    import yaml # Para leer datos como keys y paths
+    from tabulate import tabulate
+
     # Estado: Yucatán 
     # Ubicación: mi casa
     # Unidades económicas: 462111 supermercado, 462112 minisuper
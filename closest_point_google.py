@@ -1,15 +1,74 @@
 import numpy as np
 import pandas as pd
-import requests # Para acceder a la API de Google
-import re # Para usar regular expressions
-import geopandas as gpd # Para leer y manipular shapefiles
-from shapely.geometry import Point # Para crear un punto con latitud y longitud
-import yaml # Para leer datos como keys y paths
 import time
-from tabulate import tabulate
+from denue_index import a_arreglo
+from denue_store import DenueStore
+from denue_cache import como_store
+from google_client import DistanceMatrixClient
+from travel_cache import CacheDuraciones
+from distancias import haversine
+from metricas import etapa, cuenta
 
 
-def RadiousUnidadesEconomicas(*,path_shp_denue:str,codigo_act_dict:dict,lat:[float,list],lon:[float,list],metros=2000,google_api_key=None,google=False)->dict:
+def DuracionMinima(*,cliente:DistanceMatrixClient,store:DenueStore,codigo:str,lat:np.ndarray,lon:np.ndarray,
+                   k_candidatos=10,lote_candidatos=5,velocidad_max_kmh=120)->np.ndarray:
+    '''
+    Mínima duración en coche (en minutos) de cada punto a alguna unidad del código, buscando sólo
+    entre las k_candidatos unidades más cercanas en línea recta. Las candidatas se piden a la API
+    por lotes, de la más cercana a la más lejana, y un punto deja de pedir candidatas cuando la
+    distancia en línea recta a la siguiente, recorrida a velocidad_max_kmh (una cota inferior de
+    su duración), ya no puede mejorar la duración mínima encontrada.
+    ----------
+    Inputs: 
+            - cliente: DistanceMatrixClient, cliente de la API
+            - store: DenueStore, DENUE cargado
+            - codigo: str, código de 6 dígitos del DENUE
+            - lat: array, latitudes 
+            - lon: array, longitudes 
+            - k_candidatos: int, máximo de unidades por punto a medir con la API
+            - lote_candidatos: int, candidatas por punto en cada ronda de solicitudes
+            - velocidad_max_kmh: float, velocidad máxima para la cota inferior de la duración
+    Outputs: 
+            - array con la duración mínima de cada punto (NaN si no hay unidades o rutas)
+    '''
+    posiciones = store.posiciones(codigo)
+    k = min(k_candidatos,len(posiciones))
+    if k==0:
+        return np.full(len(lat),np.nan)
+
+    # Las k unidades más cercanas con el índice espacial, ordenadas por distancia sobre la esfera
+    puntos = store.indice.metrica('haversine').coordenadas(lat,lon)
+    _, cercanos = store.indice.arbol(codigo,'haversine').query(puntos,k=k)
+    cercanos = posiciones[np.asarray(cercanos).reshape(len(lat),-1)]
+    metros = haversine(lat[:,None],lon[:,None],store.latitud[cercanos],store.longitud[cercanos])
+    orden = np.argsort(metros,axis=1)
+    cercanos = np.take_along_axis(cercanos,orden,axis=1)
+    # Cota inferior de la duración (minutos) a cada candidata
+    cota = np.take_along_axis(metros,orden,axis=1)/(velocidad_max_kmh*1000/60)
+
+    mejor = np.full(len(lat),np.inf)
+    for inicio in range(0,k,lote_candidatos):
+        fin = min(inicio+lote_candidatos,k)
+        # Para cada punto sólo las candidatas del lote cuya cota es menor a la mejor duración
+        n_lote = [np.searchsorted(cota[i,inicio:fin],mejor[i]) for i in range(len(lat))]
+        activos = [i for i in range(len(lat)) if n_lote[i]>0]
+        if len(activos)==0:
+            break
+        cuenta('unidades_candidatas',int(np.sum(n_lote)))
+        candidatos = [cercanos[i,inicio:inicio+n_lote[i]] for i in activos]
+        duraciones = cliente.duraciones([(lat[i],lon[i]) for i in activos],
+                                        [list(zip(store.latitud[c],store.longitud[c])) for c in candidatos],
+                                        [store.id[c] for c in candidatos])
+        for i, d in zip(activos,duraciones):
+            if np.isfinite(d).any():
+                mejor[i] = min(mejor[i],np.nanmin(d))
+
+    mejor[np.isinf(mejor)] = np.nan
+    return mejor
+
+
+def RadiousUnidadesEconomicas(*,path_shp_denue:[str,DenueStore],codigo_act_dict:dict,lat:[float,list],lon:[float,list],metros=2000,google_api_key=None,google=False,cliente=None,cache=True,
+                              k_candidatos=10,lote_candidatos=5,velocidad_max_kmh=120,metrica='haversine')->dict:
     '''
     A partir de un radio fijo cuenta el número de unidades económicas del código especificado
     y la mínima duración en coche a alguna de las unidades, no solo en la circunferencia
@@ -17,130 +76,85 @@ def RadiousUnidadesEconomicas(*,path_shp_denue:str,codigo_act_dict:dict,lat:[flo
     Si no hay unidades devuelve NaN en la duración. 
     ----------
     Inputs: 
-            - path_shp_denue_estado: str, path al shapefile de la denue, de preferencia de un estado específico
+            - path_shp_denue_estado: str, path al shapefile de la denue, de preferencia de un estado específico,
+              o un DenueStore ya cargado para no volver a leer el shapefile
             - codigo_act_dict: dict, código de 6 dígitos del DENUE, key=clave y value=nombre
             - lat: list o float, latitudes 
             - lon: list o float, longitudes 
             - metros: float, metros a buscar
             - google_api_key: str, key de google para usar Distance Matrix API
             - google: boole, si usa o no la API de Google 
+            - cliente: DistanceMatrixClient, cliente ya configurado (p.ej. contra un stub local o con
+              un CacheDuraciones); por omisión se crea uno con google_api_key
+            - cache: CacheDuraciones del cliente que se crea; True usa el cache en disco por omisión
+              (ver travel_cache) y None o False pide todas las duraciones a la API
+            - k_candidatos, lote_candidatos, velocidad_max_kmh: ver DuracionMinima
+            - metrica: str, 'haversine', 'proyectada' o 'grados' para el conteo y la distancia lineal
     Outputs: 
             - DataFrame con duración mínima y número de unidades 
     '''
 
-    # Cargamos el shapefile del DENUE 
-    denue = gpd.read_file(path_shp_denue)
+    # Cargamos el DENUE (sólo si nos dan un path) con su índice espacial (un KD-tree por código)
+    with etapa('carga_denue'):
+        store = como_store(path_shp_denue)
+
+    # Cliente de la API Distance Matrix (pool de conexiones, reintentos y límite de tasa)
+    # con el cache en disco de duraciones, así las corridas siguientes no repiten solicitudes
+    cerrar_cliente = google and cliente is None
+    cerrar_cache = cerrar_cliente and cache is True
+    if cerrar_cliente:
+        if cerrar_cache:
+            cache = CacheDuraciones()
+        cliente = DistanceMatrixClient(google_api_key,cache=cache or None)
 
     # Convertimos en lista el código de actividad
     codigo_act = list(codigo_act_dict.keys())
     
-    # Ver si lat,lon son iterables, sino crea una lista
-    try: 
-        iter(lat)
-    except: 
-        lat = [lat]
-
-    try: 
-        iter(lon)
-    except: 
-        lon = [lon]
+    # Convertimos lat,lon en arreglos (acepta float, str, lista o Series)
+    lat = a_arreglo(lat)
+    lon = a_arreglo(lon)
+    cuenta('puntos',len(lat))
 
     # DataFrame de resultados
     df = pd.DataFrame()
 
     for codigo in codigo_act: 
         actividad = codigo_act_dict[codigo]
-        # Filtramos el DENUE con código de actividad 
-        denue_codigo = denue[denue['codigo_act']==codigo].copy()
-
-        # Si no hay esta unidad en el estado devolvemos 0's y NaN's
-        if len(denue_codigo)==0:
-            numero_unidades_radius = [0 for _ in range(len(lat))]
-            distance = [np.nan for _ in range(len(lat))]
-
+        # Contamos las unidades en el radio y la distancia lineal mínima para todos los puntos a la vez
+        # (si no hay esta unidad en el estado devuelve 0's y NaN's)
+        with etapa('consulta_indice'):
+            numero_unidades_radius, distance = store.consulta(codigo,lat,lon,metros,metrica=metrica)
+        posiciones = store.posiciones(codigo)
+
+        # Usamos la API Distance Matrix de Google para medir el tiempo en vehículo a la UE más cercana
+        # (no necesariemnte en la circunferencia) entre las k_candidatos más cercanas en línea recta
+        # La API se usa sólo si google = True
+        if google and len(posiciones)>0: 
+            with etapa('duracion_google'):
+                distance = DuracionMinima(cliente=cliente,store=store,codigo=codigo,lat=lat,lon=lon,
+                                          k_candidatos=k_candidatos,lote_candidatos=lote_candidatos,
+                                          velocidad_max_kmh=velocidad_max_kmh)
+        elif google: 
+            distance = np.full(len(lat),np.nan)
+
+        # Devolvemos el número de unidades y la duración mínima
+        df[actividad+'_numero'] = numero_unidades_radius
+        if google: 
+            df[actividad+'_duracion'] = distance
         else: 
-            # Cambiamos el sistema de coordenadas
-            denue_codigo.to_crs("EPSG:4326",inplace=True)
-
-            numero_unidades_radius = []
-            distance = []
-            for Lat,Lon in zip(lat,lon):
-                # Creamos un punto el la coordenada proporcionada
-                pt = gpd.GeoSeries([Point(Lon,Lat)])
-
-                # alpha es una constante para traducir metros en el crs especificado
-                alpha = 0.005/550
-                # Creamos la circunferencia con los metros especificados
-                circle = pt.buffer(metros*alpha)
-                # Convertimos el punto en un GeoDataFrame 
-                circle = gpd.GeoDataFrame(circle,columns=['geometry'])
-                # Cambiamos el sistema de coordenadas para que coicidan
-                circle.set_crs("EPSG:4326",inplace=True)
-                # Obtenemos la base con las intersecciones geográficas (puntos que caen en la circunferencia)
-                inter = gpd.overlay(denue_codigo, circle, how='intersection')
-                # El número de unidades al rededor del punto es len(inter)
-                numero_unidades_radius.append(len(inter))
-                
-                # Usamos la API Distance Matrix de Google para medir el tiempo en vehículo a la UE más cercana
-                # (no necesariemnte en la circunferencia)
-                # La API tiene un límite de 100=(origenes)*(destinos) elementos, así que filtramos los 100 
-                # destinos más cercanos en el sentido lineal
-                # La API se usa sólo si google = True
-                # (Sé que es tonto poner el if adentro del for, pero fue mi solución rápida) 
-                denue_codigo['distance_to_point'] = denue_codigo['geometry'].apply(lambda p: np.sqrt((p.x-pt.x)**2+(p.y-pt.y)**2)/alpha)
-                denue_codigo = denue_codigo.sort_values(by='distance_to_point',ascending=True)
-                denue_codigo.reset_index(drop=True,inplace=True)
-                denue_codigo = denue_codigo.loc[0:99,:]
-
-                if google: 
-                    # Hacemos un string con los destinos a los que se quiere medir la distancia
-                    destinations = ''
-                    for x in denue_codigo[['latitud','longitud']].values:
-                        destinations += str(x[0])+','+str(x[1])+'|'
-                    destinations = destinations[:-1]
-                    # Especificamos los otros parámetros de la API
-                    outputFormat = 'json'
-                    units = 'imperial'
-                    origins = f'{Lat},{Lon}'
-                    mode = 'driving'
-                    parameters = f'units={units}&origins={origins}&destinations={destinations}&mode={mode}&key={google_api_key}'
-                    url_google = f'https://maps.googleapis.com/maps/api/distancematrix/{outputFormat}?{parameters}'
-                    # Llamamos a la API con requests
-                    r_google = requests.get(url_google)
-                    # Leemos el resultado de la API como JSON
-                    d = r_google.json()
-                    # Almacenamos las duraciones en coche (en minutos) a cada destino, i.e., unidad económica
-                    duration = []
-                    for z in d['rows'][0]['elements']: 
-                        d = z['duration']['text']
-                        # quitamos letras y nos quedamos con números
-                        if 'hour' in d:
-                            h = re.sub('[a-z]','',d).strip().split()[0]
-                            m = re.sub('[a-z]','',d).strip().split()[1]
-                            h = float(h)
-                            m = float(m)
-                            d = 60*h+m
-                        else:
-                            d = re.sub('[a-z]','',d) 
-                            d = float(d)
-                        duration.append(d)
-                    # Obtenemos la dración mínima 
-                    duration = np.array(duration)
-                    distance.append(duration.min())
-
-                else: 
-                    distance.append(denue_codigo.loc[0,'distance_to_point'])
-        
-            # Devolvemos el número de unidades y la duración mínima
-            df.loc[:,actividad+'_numero'] = numero_unidades_radius
-            if google: 
-                df.loc[:,actividad+'_duracion'] = distance
-            else: 
-                df.loc[:,actividad+'_distancia'] = distance
+            df[actividad+'_distancia'] = distance
+
+    if cerrar_cliente:
+        cliente.close()
+    if cerrar_cache:
+        cache.close()
 
     return df
 
 if __name__=='__main__':
+    import yaml # Para leer datos como keys y paths
+    from tabulate import tabulate
+
     # Estado: Yucatán 
     # Ubicación: mi casa
     # Unidades económicas: 462111 supermercado, 462112 minisuper
@@ -0,0 +1,278 @@
+import os
+import sys
+import json
+import glob
+import shutil
+import numpy as np
+import pandas as pd
+from denue_store import DenueStore
+from metricas import etapa
+
+
+# Directorio por omisión del cache en disco (relativo al directorio de trabajo si no se define
+# la variable de ambiente DENUE_CACHE_DIR)
+CACHE_DIR = os.environ.get('DENUE_CACHE_DIR','cache')
+# Se incrementa cuando cambia el formato de los arrays guardados
+VERSION_CACHE = 4
+
+
+def firma_shapefile(path_shp:str)->dict:
+    '''
+    Tamaño y fecha de modificación del shapefile y de su .dbf (donde viven los atributos).
+    Si cambian, el cache construido a partir del shapefile ya no es válido.
+    '''
+    base = os.path.splitext(path_shp)[0]
+    firma = {}
+    for ext in ['.shp','.dbf']:
+        if os.path.exists(base+ext):
+            st = os.stat(base+ext)
+            firma[ext] = [st.st_size,st.st_mtime_ns]
+    return firma
+
+
+def guarda_arrays(directorio:str,arrays:dict,meta:dict):
+    '''
+    Guarda cada array como .npy y los metadatos en meta.json. Se escribe en un directorio
+    temporal que se renombra al final para que ningún lector vea un cache a medias.
+    '''
+    tmp = f'{directorio}.tmp-{os.getpid()}'
+    shutil.rmtree(tmp,ignore_errors=True)
+    os.makedirs(tmp)
+    for nombre, arr in arrays.items():
+        np.save(os.path.join(tmp,nombre+'.npy'),np.ascontiguousarray(arr))
+    with open(os.path.join(tmp,'meta.json'),'w') as f:
+        json.dump(meta,f)
+    shutil.rmtree(directorio,ignore_errors=True)
+    os.replace(tmp,directorio)
+
+
+def carga_arrays(directorio:str,mmap_mode='r'):
+    '''
+    Lee los metadatos y los arrays de un directorio de cache (memory-mapped por omisión,
+    así varios procesos comparten las mismas páginas)
+    '''
+    with open(os.path.join(directorio,'meta.json')) as f:
+        meta = json.load(f)
+    arrays = {nombre:np.load(os.path.join(directorio,nombre+'.npy'),mmap_mode=mmap_mode)
+              for nombre in meta['arrays']}
+    return meta, arrays
+
+
+def cache_valido(directorio:str,path_shp:str)->bool:
+    '''
+    True si el directorio tiene un cache completo del mismo shapefile (path) con la misma firma
+    '''
+    try:
+        with open(os.path.join(directorio,'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError,ValueError):
+        return False
+    return (meta.get('version')==VERSION_CACHE and meta.get('fuente')==os.path.abspath(path_shp)
+            and meta.get('firma')==firma_shapefile(path_shp))
+
+
+def _directorio(path_shp:str,clave,cache_dir:str)->str:
+    # Por omisión la clave es el nombre del shapefile (p.ej. denue_31)
+    if clave is None:
+        clave = os.path.splitext(os.path.basename(path_shp))[0]
+    return os.path.join(cache_dir,clave)
+
+
+def snapshots(path_shp_denue:str,clave:str=None,cache_dir:str=CACHE_DIR)->dict:
+    '''
+    Snapshots válidos (con deltas aplicados sobre el shapefile actual) en el cache: versión: directorio
+    '''
+    directorio = _directorio(path_shp_denue,clave,cache_dir)
+    versiones = {}
+    for d in glob.glob(glob.escape(directorio)+'.v[0-9][0-9][0-9][0-9]'):
+        if cache_valido(d,path_shp_denue):
+            versiones[int(d[-4:])] = d
+    return dict(sorted(versiones.items()))
+
+
+def cargar_denue(path_shp_denue:str,clave:str=None,cache_dir:str=CACHE_DIR,mmap_mode='r',snapshot:int=None,
+                 tipo_coordenadas=None)->DenueStore:
+    '''
+    Devuelve el DenueStore del shapefile leyendo el cache en disco. Si no existe o el shapefile
+    cambió (tamaño o fecha), lee el shapefile y reescribe el cache. Si hay snapshots con deltas
+    aplicados (ver aplica_delta) se lee el más reciente.
+    ----------
+    Inputs:
+            - path_shp_denue: str, path al shapefile de la denue
+            - clave: str, nombre del cache, p.ej. la clave del yaml ('denue_31'); por omisión el nombre del shapefile
+            - cache_dir: str, directorio donde se guardan los caches
+            - mmap_mode: str, modo de np.load ('r' memory-mapped, None lo carga en memoria)
+            - snapshot: int, versión a leer (0 es el shapefile sin deltas); por omisión la más reciente
+            - tipo_coordenadas: dtype, np.float32 copia las coordenadas a la mitad de memoria
+              (por omisión se usan los float64 memory-mapped del cache)
+    Outputs:
+            - DenueStore
+    '''
+    versiones = snapshots(path_shp_denue,clave,cache_dir)
+    if snapshot is None and versiones:
+        snapshot = max(versiones)
+    if snapshot:
+        if snapshot not in versiones:
+            raise ValueError(f'no existe el snapshot {snapshot} de {path_shp_denue}, hay {list(versiones)}')
+        _, arrays = carga_arrays(versiones[snapshot],mmap_mode=mmap_mode)
+        store = DenueStore.desde_arrays(arrays,tipo_coordenadas=tipo_coordenadas)
+        store.directorio = versiones[snapshot]
+        return store
+
+    directorio = _directorio(path_shp_denue,clave,cache_dir)
+    if not cache_valido(directorio,path_shp_denue):
+        store = DenueStore.desde_shapefile(path_shp_denue)
+        arrays = store.arrays()
+        meta = {'version':VERSION_CACHE,'fuente':os.path.abspath(path_shp_denue),
+                'firma':firma_shapefile(path_shp_denue),'arrays':list(arrays)}
+        guarda_arrays(directorio,arrays,meta)
+    with etapa('carga_cache'):
+        _, arrays = carga_arrays(directorio,mmap_mode=mmap_mode)
+        store = DenueStore.desde_arrays(arrays,tipo_coordenadas=tipo_coordenadas)
+    store.directorio = directorio
+    return store
+
+
+def codigos_cache(path_shp_denue:str,clave:str=None,cache_dir:str=CACHE_DIR):
+    '''
+    Códigos de actividad del DENUE leídos del cache (el snapshot más reciente) sin cargar el
+    store, o None si el shapefile todavía no tiene un cache válido
+    '''
+    versiones = snapshots(path_shp_denue,clave,cache_dir)
+    directorio = versiones[max(versiones)] if versiones else _directorio(path_shp_denue,clave,cache_dir)
+    if not versiones and not cache_valido(directorio,path_shp_denue):
+        return None
+    return set(np.load(os.path.join(directorio,'grupo_valores.npy')).astype(str))
+
+
+def lee_delta(path_delta:str):
+    '''
+    Lee un archivo de cambios del DENUE (csv) con las columnas operacion ('alta' o 'baja'), id,
+    codigo_act, nom_estab, latitud y longitud. Una unidad que cambió de lugar o de actividad es
+    una alta con su mismo id.
+    ----------
+    Outputs:
+            - (altas, bajas): DataFrame con las unidades nuevas y array con los ids eliminados
+    '''
+    delta = pd.read_csv(path_delta,dtype={'codigo_act':str,'nom_estab':str})
+    operacion = delta['operacion'].str.strip().str.lower()
+    if not operacion.isin(['alta','baja']).all():
+        raise ValueError(f"operacion debe ser 'alta' o 'baja' en {path_delta}")
+    altas = delta[operacion=='alta'].reset_index(drop=True)
+    altas['nom_estab'] = altas['nom_estab'].fillna('')
+    return altas, delta.loc[operacion=='baja','id'].values
+
+
+def aplica_delta(path_shp_denue:str,path_delta:str,clave:str=None,cache_dir:str=CACHE_DIR,
+                 store:DenueStore=None,conservar:int=5)->DenueStore:
+    '''
+    Aplica un archivo de cambios (ver lee_delta) al DENUE del cache y guarda el resultado como un
+    snapshot nuevo (<clave>.v0001, <clave>.v0002, ...) sin volver a leer el shapefile. Los
+    snapshots anteriores se conservan para regresar a ellos con cargar_denue(snapshot=n).
+    ----------
+    Inputs:
+            - path_shp_denue: str, path al shapefile de la denue (el del cache base)
+            - path_delta: str, archivo de cambios
+            - clave, cache_dir: ver cargar_denue
+            - store: DenueStore, versión actual ya cargada (conserva sus KD-trees); por omisión el
+              snapshot más reciente
+            - conservar: int, snapshots que se guardan (None los guarda todos)
+    Outputs:
+            - DenueStore actualizado (leído del snapshot nuevo)
+    '''
+    if store is None:
+        store = cargar_denue(path_shp_denue,clave=clave,cache_dir=cache_dir)
+    altas, bajas = lee_delta(path_delta)
+    nuevo = store.aplica_delta(altas,bajas)
+
+    versiones = snapshots(path_shp_denue,clave,cache_dir)
+    version = max(versiones,default=0)+1
+    directorio = f'{_directorio(path_shp_denue,clave,cache_dir)}.v{version:04d}'
+    meta_anterior = {}
+    if store.directorio is not None:
+        with open(os.path.join(store.directorio,'meta.json')) as f:
+            meta_anterior = json.load(f)
+    arrays = nuevo.arrays()
+    meta = {'version':VERSION_CACHE,'fuente':os.path.abspath(path_shp_denue),
+            'firma':firma_shapefile(path_shp_denue),'snapshot':version,
+            'deltas':meta_anterior.get('deltas',[])+[os.path.abspath(path_delta)],
+            'altas':len(altas),'bajas':len(bajas),'arrays':list(arrays)}
+    guarda_arrays(directorio,arrays,meta)
+
+    if conservar is not None:
+        for v in sorted(versiones)[:max(0,len(versiones)+1-conservar)]:
+            shutil.rmtree(versiones[v],ignore_errors=True)
+
+    # Leemos el snapshot (memory-mapped, así los procesos de paralelo.py lo pueden abrir)
+    # y le pasamos los árboles de los códigos que no cambiaron
+    _, arrays = carga_arrays(directorio)
+    actualizado = DenueStore.desde_arrays(arrays)
+    actualizado.directorio = directorio
+    actualizado.indice.hereda(nuevo.indice,set())
+    return actualizado
+
+
+def cargar_manzanas(path_shp_mza:str,clave:str=None,cache_dir:str=CACHE_DIR,mmap_mode='r')->pd.DataFrame:
+    '''
+    Devuelve CVEGEO y el centroide (latitud,longitud en EPSG:4326) de las manzanas del shapefile,
+    usando el cache en disco igual que cargar_denue
+    ----------
+    Inputs:
+            - path_shp_mza: str, path al shapefile de manzanas
+            - clave: str, nombre del cache, p.ej. la clave del yaml ('shp_mza_9')
+            - cache_dir: str, directorio donde se guardan los caches
+            - mmap_mode: str, modo de np.load
+    Outputs:
+            - DataFrame con CVEGEO, latitud y longitud
+    '''
+    directorio = _directorio(path_shp_mza,clave,cache_dir)
+    if not cache_valido(directorio,path_shp_mza):
+        import geopandas as gpd # Para leer y manipular shapefiles
+        shp_mza = gpd.read_file(path_shp_mza)
+        # Cambiamos el crs y calculamos el centroide
+        shp_mza = shp_mza.to_crs('EPSG:4326')
+        centroid = shp_mza.centroid
+        arrays = {'CVEGEO':shp_mza['CVEGEO'].values.astype(str),
+                  'latitud':centroid.y.values,
+                  'longitud':centroid.x.values}
+        meta = {'version':VERSION_CACHE,'fuente':os.path.abspath(path_shp_mza),
+                'firma':firma_shapefile(path_shp_mza),'arrays':list(arrays)}
+        guarda_arrays(directorio,arrays,meta)
+    _, arrays = carga_arrays(directorio,mmap_mode=mmap_mode)
+    return pd.DataFrame({'CVEGEO':arrays['CVEGEO'],'latitud':arrays['latitud'],'longitud':arrays['longitud']})
+
+
+def como_store(denue)->DenueStore:
+    '''
+    Acepta un path al shapefile del DENUE o un DenueStore ya cargado y devuelve el DenueStore.
+    Los paths se leen a través del cache en disco. Cualquier otro objeto con la misma interfaz
+    de consulta (p.ej. denue_nacional.DenueNacional) se devuelve tal cual.
+    '''
+    if isinstance(denue,(str,os.PathLike)):
+        return cargar_denue(denue)
+    return denue
+
+
+if __name__=='__main__':
+    import yaml # Para leer datos como keys y paths
+
+    # Con argumentos aplica un archivo de cambios: python denue_cache.py denue_31 cambios.csv
+    with open("denue_shapefile.yaml") as f:
+        path = yaml.load(f,Loader=yaml.FullLoader)
+    if len(sys.argv)==3:
+        clave, path_delta = sys.argv[1:]
+        store = aplica_delta(path[clave],path_delta,clave=clave)
+        print(f'{clave}: {store.directorio} ({len(store)} unidades)')
+        sys.exit()
+
+    # Conversión única de todos los shapefiles de los yaml al cache en disco
+    for clave, path_shp_denue in path.items():
+        cargar_denue(path_shp_denue,clave=clave)
+        print(f'{clave}: ok')
+
+    with open('estado_shapefile.yaml') as f:
+        path = yaml.load(f,Loader=yaml.FullLoader)
+    for clave, path_shp_mza in path.items():
+        if clave.startswith('shp_mza_'):
+            cargar_manzanas(path_shp_mza,clave=clave)
+            print(f'{clave}: ok')
@@ -0,0 +1,162 @@
+import numpy as np
+from scipy.spatial import cKDTree # Para buscar vecinos cercanos sin recorrer todo el DENUE
+from distancias import Metrica, conteos_y_vecinos, crs_utm
+from metricas import etapa
+
+
+def a_arreglo(x)->np.ndarray:
+    '''
+    Convierte una latitud o longitud (float, str, lista, Series) en un arreglo 1-D de floats
+    '''
+    return np.atleast_1d(np.asarray(x,dtype=float)).ravel()
+
+
+class DenueIndex:
+    '''
+    Índice espacial del DENUE: un KD-tree por código de actividad y métrica (ver distancias.Metrica)
+    sobre las coordenadas de las unidades. Los árboles se construyen la primera vez que se consulta
+    un código y se reutilizan en las consultas siguientes.
+    ----------
+    Inputs:
+            - x: array, longitudes de las unidades económicas
+            - y: array, latitudes de las unidades económicas
+            - codigos: array, código de actividad de cada unidad
+            - grupos: tuple, (valores,orden,inicios) ya calculados por DenueIndex.grupos,
+              para no volver a ordenar los códigos (p.ej. al leer el cache en disco)
+    '''
+
+    def __init__(self,x,y,codigos=None,grupos=None):
+        # Conservamos el tipo de las coordenadas (p.ej. float32 del DenueStore) para compartir la
+        # memoria; Metrica.coordenadas las pasa a float64 en cada consulta o KD-tree
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+
+        # Agrupamos las posiciones de las unidades por código de actividad
+        if grupos is None:
+            codigos = np.asarray(codigos).astype(str)
+            orden = np.argsort(codigos,kind='stable')
+            valores, inicios = np.unique(codigos[orden],return_index=True)
+            grupos = (valores,orden,inicios)
+        self.grupos = grupos
+        valores, orden, inicios = grupos
+        self._indices = dict(zip(np.asarray(valores).astype(str),np.split(orden,inicios[1:])))
+        self._arboles = {}
+        self._metricas = {}
+
+    @classmethod
+    def desde_geodataframe(cls,denue):
+        '''
+        Construye el índice a partir del GeoDataFrame del DENUE (cualquier crs)
+        '''
+        denue = denue.to_crs("EPSG:4326")
+        return cls(denue.geometry.x.values,denue.geometry.y.values,denue['codigo_act'].values)
+
+    def hereda(self,otro,tocados:set):
+        '''
+        Reutiliza los KD-trees ya construidos de otro índice para los códigos que no están en
+        `tocados` (las unidades de esos códigos son las mismas, sólo cambió su posición)
+        '''
+        for clave, arbol in otro._arboles.items():
+            if clave[0] not in tocados and clave not in self._arboles:
+                self._arboles[clave] = arbol
+
+    def posiciones(self,codigo:str)->np.ndarray:
+        '''
+        Devuelve las posiciones de las unidades con el código de actividad
+        '''
+        return self._indices.get(codigo,np.array([],dtype=int))
+
+    def metrica(self,metrica='haversine')->Metrica:
+        '''
+        Devuelve la Metrica (acepta el nombre o una Metrica). Con 'proyectada' sin crs se usa
+        la zona UTM de la mediana de las longitudes de las unidades, i.e., una por estado.
+        '''
+        if isinstance(metrica,Metrica):
+            return metrica
+        if metrica not in self._metricas:
+            crs = None
+            if metrica=='proyectada':
+                crs = crs_utm(np.median(self.x)) if len(self.x)>0 else 'EPSG:6372'
+            self._metricas[metrica] = Metrica(metrica,crs=crs)
+        return self._metricas[metrica]
+
+    def coordenadas(self,codigo:str,metrica='grados')->np.ndarray:
+        '''
+        Devuelve un array (m,d) con las coordenadas de las unidades del código en la métrica
+        (con 'grados' son (longitud,latitud))
+        '''
+        idx = self.posiciones(codigo)
+        return self.metrica(metrica).coordenadas(self.y[idx],self.x[idx])
+
+    def arbol(self,codigo:str,metrica='haversine'):
+        '''
+        Devuelve el KD-tree del código de actividad en la métrica o None si no hay unidades
+        '''
+        metrica = self.metrica(metrica)
+        clave = (codigo,)+metrica.clave
+        if clave not in self._arboles:
+            idx = self.posiciones(codigo)
+            if len(idx)==0:
+                self._arboles[clave] = None
+            else:
+                with etapa('construye_arbol'):
+                    self._arboles[clave] = cKDTree(self.coordenadas(codigo,metrica))
+        return self._arboles[clave]
+
+    def consulta_multiple(self,codigo:str,lat,lon,radios=(2000,),k:int=1,motor='kdtree',memoria_mb=256,metrica='haversine'):
+        '''
+        Cuenta las unidades del código dentro de varios radios y las distancias lineales a las
+        k unidades más cercanas para todos los puntos en una sola llamada
+        ----------
+        Inputs:
+                - codigo: str, código de 6 dígitos del DENUE
+                - lat: array, latitudes
+                - lon: array, longitudes
+                - radios: float o list, metros a buscar
+                - k: int, número de unidades más cercanas
+                - motor: str, 'kdtree' usa el árbol del código, 'numpy' calcula la matriz de
+                  distancias por bloques
+                - memoria_mb: float, memoria máxima por bloque cuando motor='numpy'
+                - metrica: str o Metrica, 'haversine', 'proyectada' o 'grados' (ver distancias.Metrica)
+        Outputs:
+                - (numero, distancia): arrays (n,len(radios)) con el número de unidades en cada radio
+                  y (n,k) con las distancias en metros a las k más cercanas (NaN si hay menos de k)
+        '''
+        lat = a_arreglo(lat)
+        lon = a_arreglo(lon)
+        metrica = self.metrica(metrica)
+        puntos = metrica.coordenadas(lat,lon)
+        radios = [metrica.radio(r) for r in np.atleast_1d(radios)]
+
+        if motor=='numpy':
+            numero, distancia = conteos_y_vecinos(puntos,self.coordenadas(codigo,metrica),radios,k,memoria_mb)
+            return numero, metrica.a_metros(distancia)
+        elif motor!='kdtree':
+            raise ValueError(f"motor debe ser 'kdtree' o 'numpy', no {motor!r}")
+
+        arbol = self.arbol(codigo,metrica)
+
+        # Si no hay esta unidad en el estado devolvemos 0's y NaN's
+        if arbol is None:
+            return np.zeros((len(lat),len(radios)),dtype=int), np.full((len(lat),k),np.nan)
+
+        # Sólo contamos (sin armar las listas de vecinos) en cada radio
+        numero = np.column_stack([arbol.query_ball_point(puntos,r=r,return_length=True) for r in radios])
+        distancia, _ = arbol.query(puntos,k=k)
+        distancia = np.asarray(distancia,dtype=float).reshape(len(lat),k)
+        # Si hay menos de k unidades el árbol devuelve inf
+        distancia[np.isinf(distancia)] = np.nan
+        return numero.astype(int).reshape(len(lat),len(radios)), metrica.a_metros(distancia)
+
+    def consulta(self,codigo:str,lat,lon,metros=2000,motor='kdtree',memoria_mb=256,metrica='haversine'):
+        '''
+        Cuenta las unidades del código dentro del radio y la mínima distancia lineal
+        (posiblemente fuera de la circunferencia) para todos los puntos en una sola llamada
+        (ver consulta_multiple)
+        ----------
+        Outputs:
+                - (numero, distancia): arrays con el número de unidades y la distancia en metros
+        '''
+        numero, distancia = self.consulta_multiple(codigo,lat,lon,[metros],k=1,motor=motor,
+                                                   memoria_mb=memoria_mb,metrica=metrica)
+        return numero[:,0], distancia[:,0]
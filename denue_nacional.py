@@ -0,0 +1,144 @@
+import os
+import struct
+import numpy as np
+from denue_index import a_arreglo
+from denue_cache import CACHE_DIR, cargar_denue, codigos_cache
+from distancias import haversine
+
+
+def caja_shapefile(path_shp:str)->tuple:
+    '''
+    Caja (lat_min, lat_max, lon_min, lon_max) en EPSG:4326 del shapefile, leída del encabezado
+    del .shp (y su .prj) sin cargar los registros
+    '''
+    with open(path_shp,'rb') as f:
+        encabezado = f.read(100)
+    x_min, y_min, x_max, y_max = struct.unpack('<4d',encabezado[36:68])
+    prj = os.path.splitext(path_shp)[0]+'.prj'
+    if os.path.exists(prj):
+        from pyproj import CRS, Transformer
+        with open(prj) as f:
+            crs = CRS.from_wkt(f.read())
+        if not crs.equals('EPSG:4326'):
+            # Transformamos puntos sobre los cuatro lados de la caja (en una proyección los lados
+            # se curvan, así que las esquinas no bastan)
+            t = np.linspace(0,1,21)
+            x = np.concatenate([x_min+(x_max-x_min)*t,np.full(21,x_max),x_min+(x_max-x_min)*t,np.full(21,x_min)])
+            y = np.concatenate([np.full(21,y_min),y_min+(y_max-y_min)*t,np.full(21,y_max),y_min+(y_max-y_min)*t])
+            transformer = Transformer.from_crs(crs,'EPSG:4326',always_xy=True)
+            lon, lat = transformer.transform(x,y)
+            x_min, y_min, x_max, y_max = np.min(lon), np.min(lat), np.max(lon), np.max(lat)
+    return float(y_min), float(y_max), float(x_min), float(x_max)
+
+
+def distancia_caja(lat,lon,caja:tuple)->np.ndarray:
+    '''
+    Cota inferior (aproximada) en metros de la distancia de cada punto a la caja: la distancia
+    al punto de la caja más cercano en latitud y longitud, con 1% de holgura
+    '''
+    lat_min, lat_max, lon_min, lon_max = caja
+    return 0.99*haversine(lat,lon,np.clip(lat,lat_min,lat_max),np.clip(lon,lon_min,lon_max))
+
+
+class DenueNacional:
+    '''
+    DENUE de todo el país repartido en un shard por estado. Cada consulta se manda al estado del
+    punto y a los estados vecinos que quedan dentro del radio, así los puntos cerca de una
+    frontera cuentan las unidades del otro lado. Los shards se cargan (del cache en disco) sólo
+    cuando alguna consulta los toca, así la memoria es proporcional al área consultada.
+    ----------
+    Inputs:
+            - paths: dict clave: path al shapefile del DENUE de cada estado, o path al yaml
+              (por omisión denue_shapefile.yaml)
+            - cache_dir: str, directorio del cache en disco (ver denue_cache.cargar_denue)
+    '''
+
+    def __init__(self,paths='denue_shapefile.yaml',cache_dir:str=CACHE_DIR):
+        if isinstance(paths,str):
+            import yaml # Para leer datos como keys y paths
+            with open(paths) as f:
+                paths = yaml.load(f,Loader=yaml.FullLoader)
+        self.paths = dict(paths)
+        self.cache_dir = cache_dir
+        self.claves = list(self.paths)
+        self.cajas = [caja_shapefile(self.paths[clave]) for clave in self.claves]
+        self._shards = {}
+        self._codigos = {}
+
+    def shard(self,clave:str):
+        '''
+        DenueStore del estado (se carga la primera vez que se pide)
+        '''
+        if clave not in self._shards:
+            self._shards[clave] = cargar_denue(self.paths[clave],clave=clave,cache_dir=self.cache_dir)
+        return self._shards[clave]
+
+    def codigos(self,clave:str)->set:
+        '''
+        Códigos de actividad del estado, del shard si ya está cargado o del cache en disco (sólo
+        se carga el shard si todavía no tiene cache)
+        '''
+        if clave not in self._codigos:
+            codigos = None if clave in self._shards else codigos_cache(self.paths[clave],clave,self.cache_dir)
+            if codigos is None:
+                codigos = set(np.asarray(self.shard(clave).indice.grupos[0]).astype(str))
+            self._codigos[clave] = codigos
+        return self._codigos[clave]
+
+    @property
+    def cargados(self)->list:
+        return list(self._shards)
+
+    def consulta_multiple(self,codigo:str,lat,lon,radios=(2000,),k:int=1,motor:str='kdtree',memoria_mb:float=256,metrica='haversine'):
+        '''
+        Igual que DenueStore.consulta_multiple pero sobre todos los estados. Cada punto visita los
+        shards en orden de distancia a su caja y sólo los que pueden aportar: los que quedan
+        dentro del radio mayor (conteos) o más cerca que su k-ésima unidad encontrada (vecinos).
+        Con metrica='proyectada' conviene un crs nacional (p.ej. 'EPSG:6372') para que todos los
+        estados midan en el mismo plano.
+        ----------
+        Outputs:
+                - (numero, distancia): arrays (n,len(radios)) y (n,k) en metros
+        '''
+        lat = a_arreglo(lat)
+        lon = a_arreglo(lon)
+        radios = np.atleast_1d(np.asarray(radios,dtype=float))
+        n = len(lat)
+        numero = np.zeros((n,len(radios)),dtype=int)
+        vecinos = np.full((n,k),np.inf)
+        if n==0 or not self.claves:
+            return numero, np.full((n,k),np.nan)
+
+        # Cota de la distancia de cada punto a cada shard y orden de visita por punto. Los estados
+        # sin unidades del código no aportan nada, así que nunca se visitan (si ningún estado tiene
+        # el código no se carga ningún shard)
+        cotas = np.column_stack([distancia_caja(lat,lon,caja) if codigo in self.codigos(clave) else np.full(n,np.inf)
+                                 for clave,caja in zip(self.claves,self.cajas)])
+        orden = np.argsort(cotas,axis=1,kind='stable')
+
+        for rango in range(len(self.claves)):
+            s_punto = orden[:,rango]
+            cota = cotas[np.arange(n),s_punto]
+            # Un shard sirve si puede tener unidades en el radio o más cerca que el k-ésimo vecino
+            util = np.isfinite(cota)&(cota<=np.maximum(radios.max(),vecinos[:,-1]))
+            if not util.any():
+                break
+            for s in np.unique(s_punto[util]):
+                idx = np.flatnonzero(util&(s_punto==s))
+                nn, dd = self.shard(self.claves[s]).consulta_multiple(codigo,lat[idx],lon[idx],radios,k=k,motor=motor,
+                                                                       memoria_mb=memoria_mb,metrica=metrica)
+                numero[idx] += nn
+                # Juntamos los k más cercanos del shard con los k mejores hasta ahora
+                candidatos = np.concatenate([vecinos[idx],np.where(np.isnan(dd),np.inf,dd)],axis=1)
+                vecinos[idx] = np.sort(candidatos,axis=1)[:,:k]
+
+        vecinos[np.isinf(vecinos)] = np.nan
+        return numero, vecinos
+
+    def consulta(self,codigo:str,lat,lon,metros:float=2000,motor:str='kdtree',memoria_mb:float=256,metrica='haversine'):
+        '''
+        Número de unidades en el radio y distancia a la más cercana (ver consulta_multiple)
+        '''
+        numero, distancia = self.consulta_multiple(codigo,lat,lon,[metros],k=1,motor=motor,
+                                                   memoria_mb=memoria_mb,metrica=metrica)
+        return numero[:,0], distancia[:,0]
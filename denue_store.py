@@ -0,0 +1,260 @@
+import numpy as np
+from denue_index import DenueIndex
+from keyword_index import IndiceNombres
+from metricas import etapa
+
+
+def _coordenada(valores,tipo)->np.ndarray:
+    # Conserva el tipo de punto flotante que se recibe (sin copiar los arrays memory-mapped)
+    valores = np.asarray(valores)
+    if tipo is None:
+        tipo = valores.dtype if valores.dtype in (np.float32,np.float64) else np.float64
+    return valores.astype(tipo,copy=False)
+
+
+class DenueStore:
+    '''
+    DENUE cargado una sola vez en memoria para reutilizarlo entre consultas.
+    Sólo guarda las columnas que usan las funciones de búsqueda como arrays de NumPy
+    y agrupa las unidades por código de actividad a través de su índice espacial.
+    El código de actividad se guarda como categoría (la agrupación del índice), así que no
+    hace falta un array de strings por unidad, y los nombres son opcionales.
+    ----------
+    Inputs:
+            - codigo_act: array, código de 6 dígitos del DENUE de cada unidad (puede omitirse si se dan los grupos)
+            - nom_estab: array, nombre del establecimiento (None si no se van a buscar palabras)
+            - latitud: array, latitud reportada por el DENUE
+            - longitud: array, longitud reportada por el DENUE
+            - x: array, longitud de la geometría en EPSG:4326
+            - y: array, latitud de la geometría en EPSG:4326
+            - id: array, identificador de la unidad en el DENUE (por omisión el número de renglón)
+            - grupos: tuple, agrupación por código ya calculada (ver DenueIndex)
+            - tipo_coordenadas: dtype, tipo de las coordenadas; np.float32 usa la mitad de memoria
+              (error menor a un metro), por omisión se conserva el tipo que se recibe (o float64)
+            - indice_nombres: IndiceNombres ya construido (p.ej. del cache en disco)
+    '''
+
+    # Columnas del shapefile que se conservan (además de la geometría)
+    COLUMNAS = ['id','codigo_act','nom_estab','latitud','longitud']
+
+    def __init__(self,*,codigo_act=None,nom_estab=None,latitud,longitud,x,y,id=None,grupos=None,tipo_coordenadas=None,
+                 indice_nombres=None):
+        self.latitud = _coordenada(latitud,tipo_coordenadas)
+        self.longitud = _coordenada(longitud,tipo_coordenadas)
+        self.x = _coordenada(x,tipo_coordenadas)
+        self.y = _coordenada(y,tipo_coordenadas)
+        self.id = np.arange(len(self.x)) if id is None else np.asarray(id).astype(np.int64,copy=False)
+        if grupos is None:
+            codigo_act = np.asarray(codigo_act).astype(str,copy=False)
+        self.indice = DenueIndex(self.x,self.y,codigo_act,grupos=grupos)
+        self._codigo_idx = None
+        # Directorio del cache en disco del que se leyó (ver denue_cache), si lo hay
+        self.directorio = None
+
+        # Los nombres pueden venir como (bytes utf-8, offsets) del cache y se decodifican
+        # sólo si se usan
+        self.con_nombres = nom_estab is not None
+        if nom_estab is None:
+            self._nom_estab = None
+            self._nom_estab_utf8 = (np.zeros(0,dtype=np.uint8),np.zeros(len(self.x)+1,dtype=np.int64))
+        elif isinstance(nom_estab,tuple):
+            self._nom_estab = None
+            self._nom_estab_utf8 = nom_estab
+        else:
+            self._nom_estab = np.asarray(nom_estab,dtype=object)
+            self._nom_estab_utf8 = None
+        self._indice_nombres = indice_nombres
+
+    def __len__(self):
+        return len(self.x)
+
+    @property
+    def codigo_idx(self)->np.ndarray:
+        '''
+        Número de categoría (posición en indice.grupos[0]) del código de actividad de cada unidad
+        '''
+        if self._codigo_idx is None:
+            valores, orden, inicios = self.indice.grupos
+            tipo = np.int16 if len(valores)<2**15 else np.int32
+            idx = np.empty(len(self),dtype=tipo)
+            idx[orden] = np.repeat(np.arange(len(valores),dtype=tipo),np.diff(np.append(inicios,len(self))))
+            self._codigo_idx = idx
+        return self._codigo_idx
+
+    @property
+    def codigo_act(self)->np.ndarray:
+        '''
+        Código de actividad de cada unidad (se arma de las categorías cada vez que se pide)
+        '''
+        return np.asarray(self.indice.grupos[0]).astype(str)[self.codigo_idx]
+
+    @property
+    def nom_estab(self)->np.ndarray:
+        if self._nom_estab is None:
+            datos, offsets = self._nom_estab_utf8
+            datos = bytes(datos)
+            self._nom_estab = np.array([datos[i:j].decode('utf-8') for i,j in zip(offsets[:-1],offsets[1:])],dtype=object)
+        return self._nom_estab
+
+    def arrays(self)->dict:
+        '''
+        Arrays de NumPy que representan al store (para guardarlo en disco, ver denue_cache)
+        '''
+        if self._nom_estab_utf8 is None:
+            nombres = [(n if isinstance(n,str) else '').encode('utf-8') for n in self._nom_estab]
+            offsets = np.zeros(len(nombres)+1,dtype=np.int64)
+            np.cumsum([len(n) for n in nombres],out=offsets[1:])
+            self._nom_estab_utf8 = (np.frombuffer(b''.join(nombres),dtype=np.uint8),offsets)
+        valores, orden, inicios = self.indice.grupos
+        # El índice de nombres se guarda con el store para no construirlo en cada carga
+        nombres = {f'nombres_{c}':v for c,v in self.indice_nombres.arrays().items()} if self.con_nombres else {}
+        return {'id':self.id,
+                'nom_estab_datos':self._nom_estab_utf8[0],
+                'nom_estab_offsets':self._nom_estab_utf8[1],
+                'latitud':self.latitud,
+                'longitud':self.longitud,
+                'x':self.x,
+                'y':self.y,
+                'grupo_valores':np.asarray(valores).astype(str),
+                'grupo_orden':np.asarray(orden).astype(np.int32 if len(self)<2**31 else np.int64,copy=False),
+                'grupo_inicios':np.asarray(inicios),
+                **nombres}
+
+    @classmethod
+    def desde_arrays(cls,arrays:dict,tipo_coordenadas=None):
+        '''
+        Reconstruye el store a partir de DenueStore.arrays (posiblemente memory-mapped)
+        '''
+        indice_nombres = None
+        if 'nombres_texto' in arrays:
+            indice_nombres = IndiceNombres({c:arrays[f'nombres_{c}'] for c in IndiceNombres.ARRAYS})
+        return cls(nom_estab=(arrays['nom_estab_datos'],arrays['nom_estab_offsets']),
+                   latitud=arrays['latitud'],
+                   longitud=arrays['longitud'],
+                   x=arrays['x'],
+                   y=arrays['y'],
+                   id=arrays['id'],
+                   grupos=(arrays['grupo_valores'],arrays['grupo_orden'],arrays['grupo_inicios']),
+                   tipo_coordenadas=tipo_coordenadas,
+                   indice_nombres=indice_nombres)
+
+    @classmethod
+    def desde_shapefile(cls,path_shp_denue:str,nombres:bool=True,tipo_coordenadas=None):
+        '''
+        Lee del shapefile del DENUE sólo las columnas necesarias (sin nom_estab si nombres=False)
+        '''
+        import geopandas as gpd # Para leer y manipular shapefiles
+        columnas = [c for c in cls.COLUMNAS if nombres or c!='nom_estab']
+        with etapa('lee_shapefile'):
+            try:
+                denue = gpd.read_file(path_shp_denue,columns=columnas)
+            except TypeError:
+                # Versiones de geopandas que no aceptan columns leen todas
+                denue = gpd.read_file(path_shp_denue)
+        # Cambiamos el sistema de coordenadas
+        with etapa('to_crs'):
+            denue = denue.to_crs("EPSG:4326")
+        return cls(codigo_act=denue['codigo_act'].values,
+                   nom_estab=denue['nom_estab'].values if nombres else None,
+                   latitud=denue['latitud'].values,
+                   longitud=denue['longitud'].values,
+                   x=denue.geometry.x.values,
+                   y=denue.geometry.y.values,
+                   id=denue['id'].values if 'id' in denue.columns else None,
+                   tipo_coordenadas=tipo_coordenadas)
+
+    def aplica_delta(self,altas=None,bajas=None):
+        '''
+        Devuelve un store nuevo con las bajas eliminadas y las altas agregadas, sin volver a leer
+        el shapefile. Una alta con un id que ya existe reemplaza a la unidad (p.ej. si cambió de
+        lugar o de actividad). Los KD-trees de los códigos que no cambiaron se reutilizan.
+        ----------
+        Inputs:
+                - altas: DataFrame o dict con id, codigo_act, nom_estab, latitud, longitud
+                  (y opcionalmente x, y; por omisión la longitud y latitud)
+                - bajas: array, ids de las unidades a eliminar
+        Outputs:
+                - DenueStore
+        '''
+        if altas is None:
+            altas = {c:[] for c in self.COLUMNAS}
+        id_altas = np.asarray(altas['id']).astype(np.int64)
+        bajas = np.asarray([] if bajas is None else bajas).astype(np.int64)
+        conserva = ~np.isin(self.id,np.concatenate([bajas,id_altas]))
+
+        # Los nombres se filtran sobre los bytes utf-8, sin decodificarlos
+        arrays = self.arrays()
+        datos, offsets = arrays['nom_estab_datos'], arrays['nom_estab_offsets']
+        largos = np.diff(offsets)
+        nombres = [(n if isinstance(n,str) else '').encode('utf-8') for n in altas['nom_estab']]
+        largos = np.concatenate([largos[conserva],[len(n) for n in nombres]]).astype(np.int64)
+        nuevos_offsets = np.zeros(len(largos)+1,dtype=np.int64)
+        np.cumsum(largos,out=nuevos_offsets[1:])
+        nuevos_datos = np.concatenate([np.asarray(datos)[np.repeat(conserva,np.diff(offsets))],
+                                       np.frombuffer(b''.join(nombres),dtype=np.uint8)])
+
+        latitud = np.asarray(altas['latitud'],dtype=float)
+        longitud = np.asarray(altas['longitud'],dtype=float)
+        x = np.asarray(altas['x'],dtype=float) if 'x' in altas else longitud
+        y = np.asarray(altas['y'],dtype=float) if 'y' in altas else latitud
+        codigo_act = np.asarray(altas['codigo_act']).astype(str)
+        codigos = self.codigo_act
+        nuevo = DenueStore(codigo_act=np.concatenate([codigos[conserva],codigo_act]),
+                           nom_estab=(nuevos_datos,nuevos_offsets),
+                           latitud=np.concatenate([self.latitud[conserva],latitud]),
+                           longitud=np.concatenate([self.longitud[conserva],longitud]),
+                           x=np.concatenate([self.x[conserva],x]),
+                           y=np.concatenate([self.y[conserva],y]),
+                           id=np.concatenate([self.id[conserva],id_altas]),
+                           tipo_coordenadas=self.x.dtype)
+
+        # Sólo los códigos con altas o bajas tienen que reconstruir su árbol
+        tocados = set(codigos[~conserva])|set(codigo_act)
+        nuevo.indice.hereda(self.indice,tocados)
+        nuevo.con_nombres = self.con_nombres
+        return nuevo
+
+    def posiciones(self,codigo:str)->np.ndarray:
+        '''
+        Posiciones (renglones) de las unidades con el código de actividad
+        '''
+        return self.indice.posiciones(codigo)
+
+    @property
+    def indice_nombres(self)->IndiceNombres:
+        '''
+        Índice invertido de los nombres, leído del cache o construido la primera vez que se usa
+        '''
+        if not self.con_nombres:
+            raise ValueError('el DENUE se cargó sin nombres (nombres=False), no se pueden buscar palabras')
+        if self._indice_nombres is None:
+            with etapa('construye_indice_nombres'):
+                self._indice_nombres = IndiceNombres.desde_nombres(self.nom_estab)
+        return self._indice_nombres
+
+    def busca_nombre(self,palabra:str)->np.ndarray:
+        '''
+        Posiciones de las unidades cuyo nombre contiene la palabra (sin importar mayúsculas ni acentos)
+        '''
+        return self.indice_nombres.busca(palabra)
+
+    def coordenadas(self,posiciones,metrica='grados')->np.ndarray:
+        '''
+        Coordenadas de las unidades en las posiciones en el espacio de la métrica
+        (con 'grados' son (longitud,latitud) en EPSG:4326)
+        '''
+        return self.indice.metrica(metrica).coordenadas(self.y[posiciones],self.x[posiciones])
+
+    def consulta_multiple(self,codigo:str,lat,lon,radios=(2000,),k=1,motor='kdtree',memoria_mb=256,metrica='haversine'):
+        '''
+        Número de unidades del código en varios radios y distancias a las k más cercanas
+        (ver DenueIndex.consulta_multiple)
+        '''
+        return self.indice.consulta_multiple(codigo,lat,lon,radios,k=k,motor=motor,memoria_mb=memoria_mb,metrica=metrica)
+
+    def consulta(self,codigo:str,lat,lon,metros=2000,motor='kdtree',memoria_mb=256,metrica='haversine'):
+        '''
+        Número de unidades del código en el radio y distancia mínima (ver DenueIndex.consulta)
+        '''
+        return self.indice.consulta(codigo,lat,lon,metros,motor=motor,memoria_mb=memoria_mb,metrica=metrica)
+
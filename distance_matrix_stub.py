@@ -0,0 +1,103 @@
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+
+
+# Velocidad (km/h) con la que el stub convierte la distancia en duración
+VELOCIDAD_KMH = 30
+RADIO_TIERRA = 6371008.8
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        q = parse_qs(url.query)
+        with server.lock:
+            server.solicitudes += 1
+
+        if not url.path.endswith('/distancematrix/json'):
+            return self._responde(404,{'status':'NOT_FOUND'})
+        if server.tasa_error and random.random()<server.tasa_error:
+            return self._responde(200,{'status':'OVER_QUERY_LIMIT','rows':[]})
+
+        try:
+            origenes = [tuple(map(float,o.split(','))) for o in q['origins'][0].split('|')]
+            destinos = [tuple(map(float,o.split(','))) for o in q['destinations'][0].split('|')]
+        except (KeyError,ValueError):
+            return self._responde(200,{'status':'INVALID_REQUEST','rows':[]})
+        if len(origenes)*len(destinos)>server.max_elementos:
+            return self._responde(200,{'status':'MAX_ELEMENTS_EXCEEDED','rows':[]})
+        if len(origenes)>server.max_dimension or len(destinos)>server.max_dimension:
+            return self._responde(200,{'status':'MAX_DIMENSIONS_EXCEEDED','rows':[]})
+        with server.lock:
+            server.elementos += len(origenes)*len(destinos)
+
+        # Duración = distancia haversine / velocidad
+        o = np.radians(np.array(origenes))
+        d = np.radians(np.array(destinos))
+        a = np.sin((d[None,:,0]-o[:,None,0])/2)**2 + \
+            np.cos(o[:,None,0])*np.cos(d[None,:,0])*np.sin((d[None,:,1]-o[:,None,1])/2)**2
+        metros = 2*RADIO_TIERRA*np.arcsin(np.sqrt(a))
+        segundos = metros/(server.velocidad_kmh/3.6)
+
+        rows = [{'elements':[{'status':'OK',
+                              'distance':{'text':f'{m/1000:.1f} km','value':int(round(m))},
+                              'duration':{'text':f'{max(1,int(round(s/60)))} mins','value':int(round(s))}}
+                             for m,s in zip(fila_m,fila_s)]}
+                for fila_m,fila_s in zip(metros,segundos)]
+        self._responde(200,{'status':'OK','origin_addresses':['']*len(origenes),
+                            'destination_addresses':['']*len(destinos),'rows':rows})
+
+    def _responde(self,codigo:int,cuerpo:dict):
+        datos = json.dumps(cuerpo).encode('utf-8')
+        self.send_response(codigo)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(datos)))
+        self.end_headers()
+        self.wfile.write(datos)
+
+    def log_message(self,*args):
+        pass
+
+
+def inicia_stub(puerto:int=0,velocidad_kmh:float=VELOCIDAD_KMH,tasa_error:float=0,
+                max_elementos:int=100,max_dimension:int=25):
+    '''
+    Levanta en un hilo un servidor local que imita la API Distance Matrix
+    (mismos parámetros, mismo JSON y mismos límites por solicitud)
+    ----------
+    Inputs:
+            - puerto: int, puerto local (0 elige uno libre)
+            - velocidad_kmh: float, velocidad para convertir distancia en duración
+            - tasa_error: float, probabilidad de responder OVER_QUERY_LIMIT
+            - max_elementos, max_dimension: int, límites por solicitud
+    Outputs:
+            - (server, url): el servidor (server.solicitudes, server.elementos cuentan el uso;
+              server.shutdown() lo detiene) y la url para DistanceMatrixClient
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1',puerto),_Handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.solicitudes = 0
+    server.elementos = 0
+    server.velocidad_kmh = velocidad_kmh
+    server.tasa_error = tasa_error
+    server.max_elementos = max_elementos
+    server.max_dimension = max_dimension
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/maps/api/distancematrix/json'
+    return server, url
+
+
+if __name__=='__main__':
+    server, url = inicia_stub(8765)
+    print(f'Stub de Distance Matrix en {url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
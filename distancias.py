@@ -0,0 +1,167 @@
+import numpy as np
+
+
+# alpha es una constante para traducir metros en el crs EPSG:4326 (métrica 'grados', la original)
+ALPHA = 0.005/550
+# Radio medio de la Tierra en metros
+RADIO_TIERRA = 6371008.8
+
+
+def conteos_y_vecinos(puntos,unidades,radios,k:int=1,memoria_mb:float=256):
+    '''
+    Cuenta las unidades a distancia <= radio de cada punto para varios radios y las distancias
+    a las k unidades más cercanas usando operaciones de NumPy sobre la matriz de distancias
+    puntos x unidades. La matriz se calcula por bloques para que nunca exceda memoria_mb megabytes
+    y cada bloque sirve para todos los radios.
+    ----------
+    Inputs:
+            - puntos: array (n,d), coordenadas de los puntos de consulta
+            - unidades: array (m,d), coordenadas de las unidades económicas
+            - radios: float o list, radios en las mismas unidades que las coordenadas
+            - k: int, número de vecinos más cercanos
+            - memoria_mb: float, memoria máxima para los bloques de la matriz de distancias
+    Outputs:
+            - (numero, distancia): arrays (n,len(radios)) con el número de unidades en cada radio
+              y (n,k) con las distancias ordenadas a los k vecinos (NaN si hay menos de k unidades)
+    '''
+    puntos = np.asarray(puntos,dtype=float)
+    unidades = np.asarray(unidades,dtype=float)
+    r2 = np.atleast_1d(np.asarray(radios,dtype=float))**2
+    n, m = len(puntos), len(unidades)
+
+    numero = np.zeros((n,len(r2)),dtype=int)
+    # Si no hay unidades devolvemos 0's y NaN's
+    if m==0:
+        return numero, np.full((n,k),np.nan)
+    d2_vecinos = np.full((n,k),np.inf)
+
+    # Cada elemento del bloque usa la matriz de distancias y un temporal de diferencias (float64)
+    # más la máscara del radio (bool)
+    max_elementos = max(1,int(memoria_mb*2**20//(2*8+1)))
+    bloque_m = min(m,max_elementos)
+    bloque_n = max(1,max_elementos//bloque_m)
+
+    for i in range(0,n,bloque_n):
+        p = puntos[i:i+bloque_n]
+        for j in range(0,m,bloque_m):
+            u = unidades[j:j+bloque_m]
+            # Distancia euclediana al cuadrado, una coordenada a la vez
+            d2 = np.zeros((len(p),len(u)))
+            for c in range(puntos.shape[1]):
+                dif = np.subtract.outer(p[:,c],u[:,c])
+                np.multiply(dif,dif,out=dif)
+                d2 += dif
+            for r in range(len(r2)):
+                numero[i:i+bloque_n,r] += np.count_nonzero(d2<=r2[r],axis=1)
+            # Juntamos los k más cercanos del bloque con los k mejores hasta ahora
+            if k==1:
+                np.minimum(d2_vecinos[i:i+bloque_n,0],d2.min(axis=1),out=d2_vecinos[i:i+bloque_n,0])
+            else:
+                kk = min(k,d2.shape[1])
+                candidatos = np.concatenate([d2_vecinos[i:i+bloque_n],np.partition(d2,kk-1,axis=1)[:,:kk]],axis=1)
+                d2_vecinos[i:i+bloque_n] = np.sort(candidatos,axis=1)[:,:k]
+
+    distancia = np.sqrt(d2_vecinos)
+    distancia[np.isinf(distancia)] = np.nan
+    return numero, distancia
+
+
+def conteo_y_minimo(puntos,unidades,radio:float,memoria_mb:float=256):
+    '''
+    Cuenta las unidades a distancia <= radio de cada punto y la distancia mínima a alguna
+    de ellas (ver conteos_y_vecinos)
+    ----------
+    Outputs:
+            - (numero, distancia): arrays con el número de unidades en el radio y la distancia mínima
+    '''
+    numero, distancia = conteos_y_vecinos(puntos,unidades,[radio],k=1,memoria_mb=memoria_mb)
+    return numero[:,0], distancia[:,0]
+
+
+def haversine(lat1,lon1,lat2,lon2)->np.ndarray:
+    '''
+    Distancia sobre la esfera en metros entre (lat1,lon1) y (lat2,lon2) en grados
+    (acepta arrays que se puedan combinar con broadcasting)
+    '''
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v,dtype=float)) for v in (lat1,lon1,lat2,lon2))
+    a = np.sin((lat2-lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2-lon1)/2)**2
+    return 2*RADIO_TIERRA*np.arcsin(np.sqrt(a))
+
+
+def crs_utm(lon:float)->str:
+    '''
+    EPSG de la zona UTM norte (WGS84) que contiene la longitud (México cae en las zonas 11 a 16)
+    '''
+    zona = int(np.floor((lon+180)/6))+1
+    return f'EPSG:{32600+zona}'
+
+
+class Metrica:
+    '''
+    Define cómo se miden las distancias: convierte (lat,lon) en coordenadas donde la distancia
+    euclediana es monótona en la distancia real, así los radios se prueban con distancias al
+    cuadrado (KD-tree o NumPy) sin construir polígonos.
+            - 'haversine': puntos en la esfera en 3-D (metros); la cuerda se convierte exactamente
+              en distancia sobre la esfera
+            - 'proyectada': coordenadas en metros de un crs proyectado, por omisión la zona UTM
+              del estado (p.ej. 'EPSG:6372', Lambert de México, para todo el país)
+            - 'grados': longitud y latitud en EPSG:4326 con la constante alpha (la original)
+    ----------
+    Inputs:
+            - tipo: str, 'haversine', 'proyectada' o 'grados'
+            - crs: str, crs proyectado cuando tipo='proyectada'
+    '''
+
+    TIPOS = ('haversine','proyectada','grados')
+
+    def __init__(self,tipo:str='haversine',crs:str=None):
+        if tipo not in self.TIPOS:
+            raise ValueError(f"metrica debe ser una de {self.TIPOS}, no {tipo!r}")
+        if tipo=='proyectada' and crs is None:
+            raise ValueError("metrica='proyectada' necesita un crs")
+        self.tipo = tipo
+        self.crs = crs if tipo=='proyectada' else None
+        self._transformer = None
+
+    @property
+    def clave(self)->tuple:
+        return (self.tipo,self.crs)
+
+    def coordenadas(self,lat,lon)->np.ndarray:
+        '''
+        Array (n,d) con las coordenadas de los puntos en el espacio de la métrica
+        '''
+        lat = np.asarray(lat,dtype=float)
+        lon = np.asarray(lon,dtype=float)
+        if self.tipo=='haversine':
+            phi, lam = np.radians(lat), np.radians(lon)
+            return RADIO_TIERRA*np.column_stack([np.cos(phi)*np.cos(lam),np.cos(phi)*np.sin(lam),np.sin(phi)])
+        elif self.tipo=='proyectada':
+            if self._transformer is None:
+                from pyproj import Transformer
+                self._transformer = Transformer.from_crs('EPSG:4326',self.crs,always_xy=True)
+            x, y = self._transformer.transform(lon,lat)
+            return np.column_stack([x,y])
+        return np.column_stack([lon,lat])
+
+    def radio(self,metros:float)->float:
+        '''
+        Radio en el espacio de la métrica equivalente a `metros`
+        '''
+        if self.tipo=='haversine':
+            # Cuerda que subtiende un arco de `metros` (los arcos mayores a media vuelta no existen)
+            return 2*RADIO_TIERRA*np.sin(min(metros/(2*RADIO_TIERRA),np.pi/2))
+        elif self.tipo=='proyectada':
+            return metros
+        return metros*ALPHA
+
+    def a_metros(self,d)->np.ndarray:
+        '''
+        Convierte distancias del espacio de la métrica en metros
+        '''
+        d = np.asarray(d,dtype=float)
+        if self.tipo=='haversine':
+            return 2*RADIO_TIERRA*np.arcsin(np.clip(d/(2*RADIO_TIERRA),0,1))
+        elif self.tipo=='proyectada':
+            return d
+        return d/ALPHA
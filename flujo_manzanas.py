@@ -0,0 +1,173 @@
+import os
+import json
+import glob
+import numpy as np
+import pandas as pd
+import geopandas as gpd # Para leer y manipular shapefiles
+from pyproj import Transformer
+from closest_point import RadiousUnidadesEconomicas
+from denue_cache import como_store, firma_shapefile
+from distancias import Metrica
+from grid_density import GridDensidad
+from metricas import etapa, cuenta
+
+
+def centroides(manzanas:gpd.GeoDataFrame):
+    '''
+    Centroides (latitud, longitud en EPSG:4326) de las manzanas. El centroide se calcula en el
+    crs del shapefile (proyectado en el marco geoestadístico) y después se transforman todas las
+    coordenadas a la vez con pyproj
+    ----------
+    Outputs:
+            - (latitud, longitud): arrays
+    '''
+    centroid = manzanas.geometry.centroid
+    x, y = centroid.x.values, centroid.y.values
+    if manzanas.crs is not None and not manzanas.crs.equals('EPSG:4326'):
+        transformer = Transformer.from_crs(manzanas.crs,'EPSG:4326',always_xy=True)
+        x, y = transformer.transform(x,y)
+    return np.asarray(y), np.asarray(x)
+
+
+def bloques_manzanas(path_shp_mza:str,tamano_bloque:int=50000,inicio:int=0):
+    '''
+    Lee el shapefile de manzanas por bloques de renglones (sin cargar la capa completa)
+    ----------
+    Inputs:
+            - path_shp_mza: str, path al shapefile de manzanas
+            - tamano_bloque: int, manzanas por bloque
+            - inicio: int, número de bloque donde empezar (para reanudar)
+    Outputs:
+            - genera (bloque, DataFrame con CVEGEO, latitud y longitud)
+    '''
+    bloque = inicio
+    while True:
+        a = bloque*tamano_bloque
+        with etapa('lee_shapefile'):
+            manzanas = gpd.read_file(path_shp_mza,rows=slice(a,a+tamano_bloque))
+        if len(manzanas)==0:
+            return
+        with etapa('centroides'):
+            latitud, longitud = centroides(manzanas)
+        yield bloque, pd.DataFrame({'CVEGEO':manzanas['CVEGEO'].values.astype(str),
+                                    'latitud':latitud,'longitud':longitud})
+        if len(manzanas)<tamano_bloque:
+            return
+        bloque += 1
+
+
+def _opcion_checkpoint(valor):
+    # Valor estable de las opciones que no son json (el repr de un objeto cambia en cada corrida)
+    if isinstance(valor,GridDensidad):
+        return {'grid':valor.meta}
+    if isinstance(valor,Metrica):
+        return [str(v) for v in valor.clave]
+    if isinstance(valor,(np.ndarray,np.generic)):
+        return valor.tolist()
+    raise TypeError(f'la opción {valor!r} no se puede guardar en el checkpoint')
+
+
+def _firma_denue(store)->dict:
+    # Identifica la versión del DENUE: el directorio del cache (incluye el snapshot) y su meta
+    directorio = getattr(store,'directorio',None)
+    if directorio is not None:
+        with open(os.path.join(directorio,'meta.json')) as f:
+            meta = json.load(f)
+        return {'directorio':os.path.abspath(directorio),'firma':meta.get('firma'),'snapshot':meta.get('snapshot',0)}
+    if hasattr(store,'paths'):
+        # DenueNacional: los shapefiles de los estados y los snapshots de su cache
+        from denue_cache import snapshots
+        return {clave:[firma_shapefile(path),list(snapshots(path,clave,store.cache_dir))]
+                for clave,path in store.paths.items()}
+    # Un store en memoria sin cache sólo se identifica por su tamaño
+    return {'unidades':len(store)}
+
+
+def _lee_checkpoint(path:str,estado:dict)->dict:
+    # El checkpoint sólo sirve si es del mismo shapefile, con los mismos bloques y columnas
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if any(checkpoint.get(c)!=v for c,v in estado.items()):
+        return None
+    return checkpoint
+
+
+def _escribe_checkpoint(path:str,checkpoint:dict):
+    # Escritura atómica: un crash nunca deja un checkpoint a medias
+    tmp = path+'.tmp'
+    with open(tmp,'w') as f:
+        json.dump(checkpoint,f)
+    os.replace(tmp,path)
+
+
+def procesa_manzanas(*,path_shp_mza:str,path_shp_denue,codigo_act_dict:dict,salida:str,
+                     tamano_bloque:int=50000,formato:str='csv',reanudar:bool=True,progreso=None,**opciones)->dict:
+    '''
+    Calcula los features de RadiousUnidadesEconomicas para todas las manzanas de un shapefile
+    por bloques, con memoria acotada: cada bloque se lee, se evalúa contra el índice del DENUE
+    (cargado una sola vez) y se escribe antes de leer el siguiente. Un checkpoint guarda los
+    bloques terminados, así una corrida interrumpida continúa donde se quedó.
+    ----------
+    Inputs:
+            - path_shp_mza: str, path al shapefile de manzanas
+            - path_shp_denue: str o DenueStore, DENUE del estado
+            - codigo_act_dict: dict, códigos de actividad y su nombre (ver RadiousUnidadesEconomicas)
+            - salida: str, archivo csv o, con formato='parquet', directorio con un archivo por bloque
+            - tamano_bloque: int, manzanas por bloque
+            - formato: str, 'csv' o 'parquet' (necesita pyarrow)
+            - reanudar: boole, continúa desde el checkpoint (False empieza de cero)
+            - progreso: función (bloque, filas) que se llama al terminar cada bloque
+            - opciones: argumentos de RadiousUnidadesEconomicas (metros, k, n_jobs, grid, metrica, ...)
+    Outputs:
+            - dict con los bloques y manzanas procesados
+    '''
+    if formato not in ('csv','parquet'):
+        raise ValueError(f"formato debe ser 'csv' o 'parquet', no {formato!r}")
+    store = como_store(path_shp_denue)
+
+    path_checkpoint = salida.rstrip('/')+'.checkpoint.json'
+    estado = {'fuente':os.path.abspath(path_shp_mza),'firma':firma_shapefile(path_shp_mza),
+              'tamano_bloque':tamano_bloque,'formato':formato,'codigos':[list(c) for c in codigo_act_dict.items()],
+              'denue':_firma_denue(store),'opciones':json.loads(json.dumps(opciones,default=_opcion_checkpoint))}
+    checkpoint = _lee_checkpoint(path_checkpoint,estado) if reanudar else None
+    if checkpoint is None:
+        checkpoint = dict(estado,bloques=0,filas=0,bytes=0)
+        # Empezamos de cero: borramos la salida anterior (en parquet, todas sus partes)
+        if formato=='csv' and os.path.exists(salida):
+            os.remove(salida)
+        elif formato=='parquet':
+            for parte in glob.glob(os.path.join(glob.escape(salida),'parte_*.parquet*')):
+                os.remove(parte)
+    elif formato=='csv' and os.path.exists(salida):
+        # Quitamos lo que se haya escrito después del último bloque terminado
+        with open(salida,'r+b') as f:
+            f.truncate(checkpoint['bytes'])
+    if formato=='parquet':
+        os.makedirs(salida,exist_ok=True)
+
+    for bloque, manzanas in bloques_manzanas(path_shp_mza,tamano_bloque,inicio=checkpoint['bloques']):
+        rue = RadiousUnidadesEconomicas(path_shp_denue=store,codigo_act_dict=codigo_act_dict,
+                                        lat=manzanas['latitud'].values,lon=manzanas['longitud'].values,**opciones)
+        df = pd.concat([manzanas,rue],axis=1)
+
+        with etapa('escribe_bloque'):
+            if formato=='csv':
+                with open(salida,'a',newline='') as f:
+                    df.to_csv(f,index=False,header=checkpoint['filas']==0)
+                checkpoint['bytes'] = os.path.getsize(salida)
+            else:
+                parte = os.path.join(salida,f'parte_{bloque:05d}.parquet')
+                df.to_parquet(parte+'.tmp',index=False)
+                os.replace(parte+'.tmp',parte)
+        cuenta('manzanas',len(df))
+
+        checkpoint['bloques'] = bloque+1
+        checkpoint['filas'] += len(df)
+        _escribe_checkpoint(path_checkpoint,checkpoint)
+        cuenta('bloques')
+        if progreso is not None:
+            progreso(bloque,checkpoint['filas'])
+
+    return {'bloques':checkpoint['bloques'],'filas':checkpoint['filas']}
@@ -0,0 +1,54 @@
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_DECODIFICA = {c:i for i,c in enumerate(_BASE32)}
+
+
+def codifica(lat:float,lon:float,precision:int=7)->str:
+    '''
+    Geohash de la coordenada con `precision` caracteres (7 ~ celdas de 150 m)
+    '''
+    lat_int, lon_int = [-90.0,90.0], [-180.0,180.0]
+    gh = []
+    bits, bit, par = 0, 0, True
+    while len(gh)<precision:
+        # Los bits alternan longitud (pares) y latitud (nones)
+        intervalo, valor = (lon_int,lon) if par else (lat_int,lat)
+        medio = (intervalo[0]+intervalo[1])/2
+        if valor>=medio:
+            bits = (bits<<1)|1
+            intervalo[0] = medio
+        else:
+            bits = bits<<1
+            intervalo[1] = medio
+        par = not par
+        bit += 1
+        if bit==5:
+            gh.append(_BASE32[bits])
+            bits, bit = 0, 0
+    return ''.join(gh)
+
+
+def limites(gh:str)->tuple:
+    '''
+    Caja de la celda del geohash: (lat_min, lat_max, lon_min, lon_max)
+    '''
+    lat_int, lon_int = [-90.0,90.0], [-180.0,180.0]
+    par = True
+    for c in gh:
+        v = _DECODIFICA[c]
+        for k in range(4,-1,-1):
+            intervalo = lon_int if par else lat_int
+            medio = (intervalo[0]+intervalo[1])/2
+            if (v>>k)&1:
+                intervalo[0] = medio
+            else:
+                intervalo[1] = medio
+            par = not par
+    return lat_int[0], lat_int[1], lon_int[0], lon_int[1]
+
+
+def decodifica(gh:str)->tuple:
+    '''
+    Centro de la celda del geohash: (lat, lon)
+    '''
+    lat_min, lat_max, lon_min, lon_max = limites(gh)
+    return (lat_min+lat_max)/2, (lon_min+lon_max)/2
@@ -0,0 +1,253 @@
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests # Para acceder a la API de Google
+from metricas import etapa, cuenta
+
+
+URL_DISTANCE_MATRIX = 'https://maps.googleapis.com/maps/api/distancematrix/json'
+# Límites de la API por solicitud: orígenes*destinos <= 100 y a lo más 25 orígenes o 25 destinos
+MAX_ELEMENTOS = 100
+MAX_DIMENSION = 25
+# Estados de la API que vale la pena reintentar
+ESTADOS_REINTENTO = {'OVER_QUERY_LIMIT','UNKNOWN_ERROR'}
+# Fracción mínima de los elementos de una solicitud (orígenes*destinos) que deben ser pares pedidos
+APROVECHAMIENTO = 0.8
+
+
+class DistanceMatrixError(RuntimeError):
+    '''
+    Error de la API Distance Matrix que no se resuelve reintentando (p.ej. REQUEST_DENIED)
+    '''
+
+
+class LimitadorTasa:
+    '''
+    Token bucket compartido entre hilos: permite a lo más `por_segundo` solicitudes por segundo
+    (None no limita)
+    '''
+
+    def __init__(self,por_segundo:float=None):
+        self.por_segundo = por_segundo
+        self._siguiente = time.monotonic()
+        self._lock = threading.Lock()
+
+    def espera(self):
+        if not self.por_segundo:
+            return
+        with self._lock:
+            ahora = time.monotonic()
+            turno = max(ahora,self._siguiente)
+            self._siguiente = turno+1/self.por_segundo
+        if turno>ahora:
+            time.sleep(turno-ahora)
+
+
+def empaqueta(destinos_por_origen:list,max_elementos:int=MAX_ELEMENTOS,max_dimension:int=MAX_DIMENSION,
+              aprovechamiento:float=APROVECHAMIENTO)->list:
+    '''
+    Agrupa las consultas (origen, destinos) en solicitudes que respetan los límites de la API.
+    Los destinos de cada origen se parten en bloques de a lo más max_dimension. Como la API
+    calcula (y cobra) orígenes*destinos de la unión, un bloque sólo se junta con una solicitud
+    que ya tiene alguno de sus destinos y si al menos `aprovechamiento` de los elementos de la
+    solicitud siguen siendo pares que se quieren; si no, va en su propia solicitud (1 x n).
+    ----------
+    Inputs:
+            - destinos_por_origen: list, para cada origen la lista de destinos (tuplas lat,lon)
+            - max_elementos: int, máximo de orígenes*destinos por solicitud
+            - max_dimension: int, máximo de orígenes o de destinos por solicitud
+            - aprovechamiento: float, fracción mínima de elementos pedidos que se usan
+    Outputs:
+            - list de solicitudes, cada una (orígenes, destinos, pares) donde pares son los
+              (i origen, destino) que se quieren de la solicitud
+    '''
+    tope = min(max_dimension,max_elementos)
+    bloques = [(i,list(dict.fromkeys(destinos[j:j+tope]))) for i,destinos in enumerate(destinos_por_origen)
+               for j in range(0,len(destinos),tope)]
+
+    solicitudes = []
+    # Solicitudes que todavía aceptan orígenes, por cada uno de sus destinos
+    abiertas = {}
+    for i, bloque in bloques:
+        elegida = None
+        candidatas = {s for d in bloque for s in abiertas.get(d,())}
+        for s in sorted(candidatas,reverse=True):
+            origenes, destinos, pares = solicitudes[s]
+            n_origenes = len(origenes)+(i not in origenes)
+            n_destinos = len(destinos)+sum(d not in destinos for d in bloque)
+            if (n_origenes<=max_dimension and n_destinos<=max_dimension and n_origenes*n_destinos<=max_elementos
+                    and len(pares)+len(bloque)>=aprovechamiento*n_origenes*n_destinos):
+                elegida = s
+                break
+        if elegida is None:
+            elegida = len(solicitudes)
+            solicitudes.append(([],{},[]))
+        origenes, destinos, pares = solicitudes[elegida]
+        if i not in origenes:
+            origenes.append(i)
+        destinos.update(dict.fromkeys(bloque))
+        pares += [(i,d) for d in bloque]
+        # Una solicitud llena ya no se ofrece; las demás quedan registradas en sus destinos
+        llena = len(origenes)>=max_dimension or (len(origenes)+1)*len(destinos)>max_elementos
+        for d in destinos:
+            if llena:
+                abiertas.get(d,set()).discard(elegida)
+            else:
+                abiertas.setdefault(d,set()).add(elegida)
+    return [(origenes,list(destinos),pares) for origenes,destinos,pares in solicitudes]
+
+
+class DistanceMatrixClient:
+    '''
+    Cliente de la API Distance Matrix: reutiliza conexiones (requests.Session), manda varias
+    solicitudes en paralelo con un pool de hilos, limita la tasa de solicitudes, reintenta con
+    backoff exponencial y lee la duración numérica (duration.value, en segundos).
+    ----------
+    Inputs:
+            - google_api_key: str, key de google para usar Distance Matrix API
+            - url: str, endpoint de la API (p.ej. el de distance_matrix_stub para pruebas)
+            - mode: str, modo de transporte
+            - hilos: int, solicitudes simultáneas
+            - solicitudes_por_segundo: float, tasa máxima de solicitudes (None no limita)
+            - max_reintentos: int, reintentos por solicitud ante errores temporales
+            - backoff: float, segundos de espera del primer reintento (se duplica en cada uno)
+            - timeout: float, segundos de espera de cada solicitud
+            - max_elementos, max_dimension: int, límites de la API por solicitud
+            - aprovechamiento: float, fracción mínima de elementos pedidos que se usan (ver empaqueta)
+            - cache: CacheDuraciones, cache en disco que se consulta antes de llamar a la API
+    '''
+
+    def __init__(self,google_api_key:str=None,*,url:str=URL_DISTANCE_MATRIX,mode:str='driving',hilos:int=8,
+                 solicitudes_por_segundo:float=None,max_reintentos:int=5,backoff:float=0.5,timeout:float=30,
+                 max_elementos:int=MAX_ELEMENTOS,max_dimension:int=MAX_DIMENSION,
+                 aprovechamiento:float=APROVECHAMIENTO,cache=None):
+        self.google_api_key = google_api_key
+        self.url = url
+        self.mode = mode
+        self.hilos = hilos
+        self.limitador = LimitadorTasa(solicitudes_por_segundo)
+        self.max_reintentos = max_reintentos
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_elementos = max_elementos
+        self.max_dimension = max_dimension
+        self.aprovechamiento = aprovechamiento
+        self.cache = cache
+        self.solicitudes = 0
+        self._lock = threading.Lock()
+
+        # Una sesión con un pool de conexiones del tamaño del pool de hilos
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=hilos,pool_maxsize=hilos)
+        self.session.mount('http://',adapter)
+        self.session.mount('https://',adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def _solicitud(self,origenes:list,destinos:list)->np.ndarray:
+        '''
+        Una solicitud a la API, devuelve la matriz orígenes x destinos de duraciones en minutos
+        (NaN si no hay ruta)
+        '''
+        params = {'origins':'|'.join(f'{lat},{lon}' for lat,lon in origenes),
+                  'destinations':'|'.join(f'{lat},{lon}' for lat,lon in destinos),
+                  'mode':self.mode,
+                  'key':self.google_api_key}
+        for intento in range(self.max_reintentos+1):
+            self.limitador.espera()
+            with self._lock:
+                self.solicitudes += 1
+            cuenta('api_solicitudes')
+            if intento>0:
+                cuenta('api_reintentos')
+            estado = None
+            try:
+                with etapa('api_http'):
+                    r = self.session.get(self.url,params=params,timeout=self.timeout)
+                if r.status_code==429 or r.status_code>=500:
+                    estado = f'HTTP {r.status_code}'
+                else:
+                    r.raise_for_status()
+                    d = r.json()
+                    estado = d.get('status')
+                    if estado=='OK':
+                        break
+                    if estado not in ESTADOS_REINTENTO:
+                        raise DistanceMatrixError(f"{estado}: {d.get('error_message','')}")
+            except (requests.ConnectionError,requests.Timeout) as e:
+                estado = repr(e)
+            if intento==self.max_reintentos:
+                raise DistanceMatrixError(f'Se agotaron los reintentos, último error: {estado}')
+            # Backoff exponencial con jitter
+            time.sleep(self.backoff*2**intento*(1+random.random()))
+
+        cuenta('api_elementos',len(origenes)*len(destinos))
+        duraciones = np.full((len(origenes),len(destinos)),np.nan)
+        for i, row in enumerate(d['rows']):
+            for j, z in enumerate(row['elements']):
+                if z.get('status')=='OK':
+                    duraciones[i,j] = z['duration']['value']/60
+        return duraciones
+
+    def duraciones(self,origenes:list,destinos_por_origen:list,ids_por_origen:list=None)->list:
+        '''
+        Duraciones en minutos de cada origen a cada uno de sus destinos. Si el cliente tiene cache
+        y se dan los ids de los destinos, sólo se piden a la API las que no están en el cache.
+        ----------
+        Inputs:
+                - origenes: list, tuplas (lat,lon) de los orígenes
+                - destinos_por_origen: list, para cada origen la lista de destinos (lat,lon)
+                - ids_por_origen: list, para cada origen los ids del DENUE de sus destinos
+        Outputs:
+                - list de arrays, para cada origen las duraciones a sus destinos (NaN si no hay ruta)
+        '''
+        destinos_por_origen = [[tuple(d) for d in destinos] for destinos in destinos_por_origen]
+        if self.cache is None or ids_por_origen is None:
+            return self._duraciones_api(origenes,destinos_por_origen)
+
+        # Consultamos el cache y sólo pedimos a la API los destinos que faltan
+        resultado, faltan = [], []
+        for (lat,lon), ids in zip(origenes,ids_por_origen):
+            minutos, encontrado = self.cache.obtiene(lat,lon,ids,self.mode)
+            cuenta('cache_aciertos',int(encontrado.sum()))
+            cuenta('cache_fallos',int((~encontrado).sum()))
+            resultado.append(minutos)
+            faltan.append(np.flatnonzero(~encontrado))
+        nuevos = self._duraciones_api(origenes,[[destinos_por_origen[i][j] for j in f] for i,f in enumerate(faltan)])
+
+        for i, (f,minutos) in enumerate(zip(faltan,nuevos)):
+            if len(f)>0:
+                resultado[i][f] = minutos
+                lat, lon = origenes[i]
+                self.cache.guarda(lat,lon,[ids_por_origen[i][j] for j in f],minutos,self.mode)
+        return resultado
+
+    def _duraciones_api(self,origenes:list,destinos_por_origen:list)->list:
+        '''
+        Duraciones de cada origen a sus destinos pidiéndolas todas a la API
+        '''
+        solicitudes = empaqueta(destinos_por_origen,self.max_elementos,self.max_dimension,self.aprovechamiento)
+
+        def corre(solicitud):
+            ids, destinos, pares = solicitud
+            matriz = self._solicitud([tuple(origenes[i]) for i in ids],destinos)
+            fila = {i:k for k,i in enumerate(ids)}
+            columna = {d:k for k,d in enumerate(destinos)}
+            return {(i,d):matriz[fila[i],columna[d]] for i,d in pares}
+
+        resultados = {}
+        with ThreadPoolExecutor(max_workers=self.hilos) as pool:
+            for r in pool.map(corre,solicitudes):
+                resultados.update(r)
+
+        return [np.array([resultados[(i,d)] for d in destinos],dtype=float)
+                for i,destinos in enumerate(destinos_por_origen)]
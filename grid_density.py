@@ -0,0 +1,160 @@
+import os
+import numpy as np
+from denue_index import a_arreglo
+from denue_cache import CACHE_DIR, cargar_denue, carga_arrays, guarda_arrays
+
+
+def tamano_celda(precision:int)->tuple:
+    '''
+    Tamaño (dlat, dlon) en grados de las celdas geohash con `precision` caracteres
+    (los bits alternan empezando por la longitud)
+    '''
+    bits = 5*precision
+    return 180/2**(bits//2), 360/2**(bits-bits//2)
+
+
+def error_celda(dlat:float,dlon:float,lat_min:float,lat_max:float)->float:
+    '''
+    Error máximo de posición en metros al usar el centro de la celda: media diagonal de la celda
+    más ancha de la malla (la más cercana al ecuador)
+    '''
+    lat = 0 if lat_min<=0<=lat_max else min(abs(lat_min),abs(lat_max))
+    return 0.5*111320*float(np.hypot(dlat,dlon*np.cos(np.radians(lat))))
+
+
+class GridDensidad:
+    '''
+    Tabla precalculada sobre la malla de celdas geohash de un estado: para cada código de
+    actividad y celda guarda el número de unidades en varios radios y la distancia a la unidad
+    más cercana, medidos desde el centro de la celda. Una consulta sólo calcula el renglón y la
+    columna de la celda de cada punto, así que responde en microsegundos con el error de
+    posición de media celda (meta['error_m']); los radios menores a ese error no se responden
+    desde la tabla.
+    ----------
+    Inputs:
+            - meta: dict, origen, tamaño y forma de la malla, radios, métrica y códigos
+            - arrays: dict, conteos_<codigo> (filas,columnas,radios) y distancia_<codigo> (filas,columnas)
+    '''
+
+    def __init__(self,meta:dict,arrays:dict):
+        self.meta = meta
+        self.arrays = arrays
+        self.radios = meta['radios']
+        self.metrica = meta['metrica']
+        self.codigos = meta['codigos']
+        self.dlat, self.dlon = meta['dlat'], meta['dlon']
+        self.lat0, self.lon0 = meta['lat0'], meta['lon0']
+        self.filas, self.columnas = meta['filas'], meta['columnas']
+        # Las tablas anteriores no guardaban el error
+        self.error_m = meta.get('error_m',error_celda(self.dlat,self.dlon,self.lat0,self.lat0+self.filas*self.dlat))
+
+    @classmethod
+    def carga(cls,directorio:str):
+        '''
+        Lee la tabla del disco (memory-mapped)
+        '''
+        meta, arrays = carga_arrays(directorio)
+        return cls(meta,arrays)
+
+    def celdas(self,lat,lon):
+        '''
+        Renglón y columna de la celda de cada punto y si el punto cae dentro de la malla
+        '''
+        lat = a_arreglo(lat)
+        lon = a_arreglo(lon)
+        fila = np.floor((lat-self.lat0)/self.dlat).astype(np.int64)
+        columna = np.floor((lon-self.lon0)/self.dlon).astype(np.int64)
+        dentro = (fila>=0)&(fila<self.filas)&(columna>=0)&(columna<self.columnas)
+        return np.where(dentro,fila,0), np.where(dentro,columna,0), dentro
+
+    def cubre(self,codigo:str,metros,k:int=1,metrica='haversine')->bool:
+        '''
+        True si la tabla tiene el código, todos los radios, k=1 y la misma métrica, y ningún radio
+        es menor al error de posición de la celda
+        '''
+        metros = [float(m) for m in np.atleast_1d(metros)]
+        return (codigo in self.codigos and k==1 and metrica==self.metrica
+                and all(m in self.radios and m>=self.error_m for m in metros))
+
+    def consulta(self,codigo:str,lat,lon,metros):
+        '''
+        Número de unidades en los radios y distancia a la más cercana desde la celda de cada punto
+        ----------
+        Outputs:
+                - (numero, distancia, dentro): arrays (n,len(metros)), (n,1) y máscara de los puntos
+                  dentro de la malla (los de afuera hay que calcularlos exactos)
+        '''
+        fila, columna, dentro = self.celdas(lat,lon)
+        r = [self.radios.index(float(m)) for m in np.atleast_1d(metros)]
+        numero = np.asarray(self.arrays[f'conteos_{codigo}'][fila,columna][:,r],dtype=int)
+        distancia = np.asarray(self.arrays[f'distancia_{codigo}'][fila,columna],dtype=float)[:,None]
+        return numero, distancia, dentro
+
+
+def precalcula_grid(store,codigos:list,directorio:str,radios=(500,1000,2000),precision:int=7,margen_m:float=2000,
+                    metrica='haversine',bloque_celdas:int=200000)->GridDensidad:
+    '''
+    Precalcula y guarda la tabla de GridDensidad para el DENUE de un estado
+    ----------
+    Inputs:
+            - store: DenueStore, DENUE del estado
+            - codigos: list, códigos de actividad a precalcular
+            - directorio: str, donde se guarda la tabla
+            - radios: list, metros de los conteos
+            - precision: int, caracteres del geohash de las celdas (7 ~ 150 m, error de ~110 m; 6 ~ 0.6x1.2 km,
+              error de ~650 m, sólo sirve para radios de 1 km o más pero ocupa 32 veces menos)
+            - margen_m: float, metros alrededor de las unidades que también cubre la malla
+            - metrica: str, métrica de las distancias (ver distancias.Metrica)
+            - bloque_celdas: int, celdas por consulta al índice (para acotar la memoria)
+    Outputs:
+            - GridDensidad
+    '''
+    dlat, dlon = tamano_celda(precision)
+    # Malla alineada a las celdas geohash que cubre las unidades más el margen
+    margen = margen_m/111320
+    margen_lon = margen/max(np.cos(np.radians(np.max(np.abs(store.y)))),0.1)
+    i0 = int(np.floor((np.min(store.y)-margen+90)/dlat))
+    i1 = int(np.ceil((np.max(store.y)+margen+90)/dlat))
+    j0 = int(np.floor((np.min(store.x)-margen_lon+180)/dlon))
+    j1 = int(np.ceil((np.max(store.x)+margen_lon+180)/dlon))
+    lat0, lon0 = i0*dlat-90, j0*dlon-180
+    filas, columnas = i1-i0, j1-j0
+
+    # Centros de las celdas
+    lat_c = lat0+(np.arange(filas)+0.5)*dlat
+    lon_c = lon0+(np.arange(columnas)+0.5)*dlon
+    lat_c, lon_c = [v.ravel() for v in np.meshgrid(lat_c,lon_c,indexing='ij')]
+
+    # El tipo de los conteos depende del máximo posible
+    tipo = np.uint16 if len(store)<2**16 else np.uint32
+    arrays = {}
+    for codigo in codigos:
+        conteos = np.zeros((len(lat_c),len(radios)),dtype=tipo)
+        distancia = np.zeros(len(lat_c),dtype=np.float32)
+        for b in range(0,len(lat_c),bloque_celdas):
+            n, d = store.consulta_multiple(codigo,lat_c[b:b+bloque_celdas],lon_c[b:b+bloque_celdas],radios,k=1,metrica=metrica)
+            conteos[b:b+bloque_celdas] = n
+            distancia[b:b+bloque_celdas] = d[:,0]
+        arrays[f'conteos_{codigo}'] = conteos.reshape(filas,columnas,len(radios))
+        arrays[f'distancia_{codigo}'] = distancia.reshape(filas,columnas)
+
+    meta = {'precision':precision,'dlat':dlat,'dlon':dlon,'lat0':lat0,'lon0':lon0,'filas':filas,
+            'columnas':columnas,'error_m':error_celda(dlat,dlon,lat0,lat0+filas*dlat),
+            'radios':[float(r) for r in radios],'metrica':metrica,'codigos':list(codigos),'arrays':list(arrays)}
+    guarda_arrays(directorio,arrays,meta)
+    return GridDensidad.carga(directorio)
+
+
+if __name__=='__main__':
+    import yaml # Para leer datos como keys y paths
+
+    # Precálculo de las tablas de los estados del yaml para los códigos de places_data.py
+    with open("denue_shapefile.yaml") as f:
+        path = yaml.load(f,Loader=yaml.FullLoader)
+
+    codigos = ['522110','611121','611131','462111','463310','463211',
+               '464121','622111','512130','722511','722515','721111']
+    for clave, path_shp_denue in path.items():
+        store = cargar_denue(path_shp_denue,clave=clave)
+        grid = precalcula_grid(store,codigos,os.path.join(CACHE_DIR,f'grid_{clave}'))
+        print(f'{clave}: {grid.filas}x{grid.columnas} celdas')
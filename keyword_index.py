@@ -0,0 +1,132 @@
+import re
+import unicodedata
+import numpy as np
+
+
+# Separador de los nombres en el texto del índice (normaliza deja un solo espacio entre palabras,
+# así que nunca aparece dentro de un nombre ni de una palabra clave)
+SEPARADOR = b'\n'
+
+
+def normaliza(texto)->str:
+    '''
+    Pasa el texto a mayúsculas, le quita acentos y deja un solo espacio entre palabras
+    (los nombres vacíos o NaN se vuelven '')
+    '''
+    if not isinstance(texto,str):
+        return ''
+    texto = unicodedata.normalize('NFKD',texto.upper())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return ' '.join(texto.split())
+
+
+def nombre_columna(palabra:str)->str:
+    '''
+    Nombre de columna para una palabra clave: normalizada, en minúsculas y con '_'
+    en lugar de espacios y signos (p.ej. 'Café Punta' -> 'cafe_punta')
+    '''
+    return re.sub('[^a-z0-9]+','_',normaliza(palabra).lower()).strip('_')
+
+
+def _codigos_trigramas(texto:np.ndarray)->np.ndarray:
+    # Cada trigrama de bytes como un entero de 24 bits
+    texto = texto.astype(np.uint32)
+    return texto[:-2]<<16|texto[1:-1]<<8|texto[2:]
+
+
+class IndiceNombres:
+    '''
+    Índice invertido de trigramas sobre los nombres normalizados de los establecimientos. Los
+    nombres se guardan como un solo texto utf-8 y para cada trigrama (de bytes) las posiciones
+    del texto donde aparece. Una búsqueda toma las posiciones del trigrama menos frecuente de la
+    palabra y compara el resto de sus bytes en esas posiciones del texto, vectorizado sobre
+    todas las posiciones (una palabra de 3 bytes no necesita comparación). Las palabras de 1 o 2 bytes son los trigramas que empiezan con
+    ellas, un rango contiguo del índice. Todo son arrays de NumPy que se guardan en el cache del
+    DENUE (ver DenueStore.arrays), así que el índice se construye una sola vez.
+    ----------
+    Inputs:
+            - arrays: dict, texto (uint8), renglon (nombre al que pertenece cada byte del texto),
+              codigos (trigramas distintos ordenados), listas (inicio de las posiciones de cada
+              trigrama) y posiciones
+    '''
+
+    # Nombres de los arrays en el cache
+    ARRAYS = ['texto','renglon','codigos','listas','posiciones']
+
+    def __init__(self,arrays:dict):
+        self.texto = arrays['texto']
+        self.renglon = arrays['renglon']
+        self.codigos = arrays['codigos']
+        self.listas = arrays['listas']
+        self.posiciones = arrays['posiciones']
+
+    @classmethod
+    def desde_nombres(cls,nombres):
+        '''
+        Construye el índice a partir de los nom_estab de las unidades
+        '''
+        nombres = [normaliza(n).encode('utf-8') for n in nombres]
+        # Dos separadores al final para que cada byte de un nombre empiece un trigrama
+        texto = np.frombuffer(SEPARADOR.join(nombres)+2*SEPARADOR,dtype=np.uint8)
+        largos = np.array([len(n)+1 for n in nombres],dtype=np.int64)
+        renglon = np.repeat(np.arange(len(nombres),dtype=np.int32),largos)
+        renglon = np.append(renglon,np.full(len(texto)-len(renglon),max(len(nombres)-1,0),dtype=np.int32))
+
+        # Posiciones ordenadas por trigrama y, dentro de cada trigrama, por posición
+        codigos = _codigos_trigramas(texto)
+        tipo = np.int32 if len(texto)<2**31 else np.int64
+        posiciones = np.argsort(codigos,kind='stable').astype(tipo)
+        codigos, listas = np.unique(codigos[posiciones],return_index=True)
+        listas = np.append(listas,len(posiciones)).astype(np.int64)
+        return cls({'texto':texto,'renglon':renglon,'codigos':codigos,'listas':listas,'posiciones':posiciones})
+
+    def arrays(self)->dict:
+        return {nombre:getattr(self,nombre) for nombre in self.ARRAYS}
+
+    def _rango(self,desde:int,hasta:int)->np.ndarray:
+        # Posiciones de los trigramas con código en [desde,hasta)
+        a, b = np.searchsorted(self.codigos,[desde,hasta])
+        return self.posiciones[self.listas[a]:self.listas[b]]
+
+    def busca(self,palabra:str)->np.ndarray:
+        '''
+        Posiciones (ordenadas) de los nombres que contienen la palabra normalizada
+        '''
+        palabra = np.frombuffer(normaliza(palabra).encode('utf-8'),dtype=np.uint8)
+        if len(palabra)==0:
+            return np.zeros(0,dtype=np.int32)
+
+        if len(palabra)<3:
+            # Los trigramas que empiezan con la palabra son un rango de códigos
+            prefijo = 0
+            for b in palabra:
+                prefijo = prefijo<<8|int(b)
+            corrimiento = 8*(3-len(palabra))
+            p = np.sort(self._rango(prefijo<<corrimiento,(prefijo+1)<<corrimiento))
+        else:
+            # Tamaño de la lista de cada trigrama de la palabra (si alguno no aparece no hay resultados)
+            codigos = _codigos_trigramas(palabra)
+            a = np.minimum(np.searchsorted(self.codigos,codigos),max(len(self.codigos)-1,0))
+            if len(self.codigos)==0 or (self.codigos[a]!=codigos).any():
+                return np.zeros(0,dtype=np.int32)
+            # Inicios posibles según el trigrama menos frecuente; el resto de los bytes de la palabra
+            # se compara en el texto para todos los inicios a la vez (una palabra de 3 bytes no
+            # necesita comparación)
+            j = int(np.argmin(self.listas[a+1]-self.listas[a]))
+            p = self.posiciones[self.listas[a[j]]:self.listas[a[j]+1]]-j
+            if len(codigos)>1:
+                p = p[(p>=0)&(p+len(palabra)<=len(self.texto))]
+                for k in [*range(j+3,len(palabra)),*range(j-1,-1,-1)]:
+                    p = p[self.texto[p+k]==palabra[k]]
+
+        # Nombre al que pertenece cada posición (p está ordenado, así que basta quitar los repetidos seguidos)
+        nombres = self.renglon[p]
+        nuevo = np.ones(len(nombres),dtype=bool)
+        nuevo[1:] = nombres[1:]!=nombres[:-1]
+        return nombres[nuevo].astype(np.int32)
+
+    def busca_varias(self,palabras:list)->dict:
+        '''
+        Busca varias palabras, devuelve un dict palabra: posiciones
+        '''
+        return {p:self.busca(p) for p in palabras}
@@ -0,0 +1,150 @@
+import sys
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+
+# Colectores activos: las funciones instrumentadas reportan a todos (sin colectores no hacen nada)
+_ACTIVAS = []
+
+
+def _memoria_max_mb()->float:
+    # Memoria residente máxima del proceso (ru_maxrss está en KB en Linux y en bytes en macOS)
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/2**20 if sys.platform=='darwin' else rss/2**10
+
+
+class Metricas:
+    '''
+    Colector de métricas de una corrida: tiempo y llamadas por etapa (p.ej. leer el shapefile,
+    construir los árboles, consultar el índice, llamar a la API), contadores (puntos, unidades
+    candidatas, solicitudes, aciertos del cache) y memoria. Se activa con `with Metricas() as m:`
+    y al final m.resumen() o m.prometheus() lo reportan. Las etapas que corren en varios hilos
+    (p.ej. api_http) suman el tiempo de todos, así que pueden pasar del 100%.
+    ----------
+    Inputs:
+            - callback: función (etapa, segundos, memoria_mb) que se llama al terminar cada etapa
+            - memoria: boole, mide el pico de memoria de cada etapa con tracemalloc (más lento)
+    '''
+
+    def __init__(self,callback=None,memoria:bool=False):
+        self.callback = callback
+        self.memoria = memoria
+        self.segundos = {}
+        self.llamadas = {}
+        self.memoria_pico_mb = {}
+        self.contadores = {}
+        self._lock = threading.Lock()
+        self._inicio = None
+        self._iniciado_tracemalloc = False
+
+    def __enter__(self):
+        self._inicio = time.perf_counter()
+        if self.memoria and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._iniciado_tracemalloc = True
+        _ACTIVAS.append(self)
+        return self
+
+    def __exit__(self,*args):
+        _ACTIVAS.remove(self)
+        if self._iniciado_tracemalloc:
+            tracemalloc.stop()
+            self._iniciado_tracemalloc = False
+        self.segundos_total = time.perf_counter()-self._inicio
+        self.memoria_max_mb = _memoria_max_mb()
+
+    def registra_etapa(self,nombre:str,segundos:float,memoria_mb:float=None):
+        with self._lock:
+            self.segundos[nombre] = self.segundos.get(nombre,0)+segundos
+            self.llamadas[nombre] = self.llamadas.get(nombre,0)+1
+            if memoria_mb is not None:
+                self.memoria_pico_mb[nombre] = max(self.memoria_pico_mb.get(nombre,0),memoria_mb)
+        if self.callback is not None:
+            self.callback(nombre,segundos,memoria_mb)
+
+    def cuenta(self,nombre:str,n=1):
+        with self._lock:
+            self.contadores[nombre] = self.contadores.get(nombre,0)+n
+
+    def como_dict(self)->dict:
+        return {'etapas':{nombre:{'segundos':self.segundos[nombre],'llamadas':self.llamadas[nombre],
+                                  'memoria_pico_mb':self.memoria_pico_mb.get(nombre)}
+                          for nombre in self.segundos},
+                'contadores':dict(self.contadores),
+                'segundos_total':getattr(self,'segundos_total',None),
+                'memoria_max_mb':getattr(self,'memoria_max_mb',None)}
+
+    def resumen(self)->str:
+        '''
+        Tabla de texto con las etapas ordenadas por tiempo y los contadores
+        '''
+        total = getattr(self,'segundos_total',None)
+        lineas = [f'{"etapa":<28}{"segundos":>12}{"%":>8}{"llamadas":>10}{"memoria MB":>12}']
+        for nombre in sorted(self.segundos,key=self.segundos.get,reverse=True):
+            s = self.segundos[nombre]
+            porcentaje = f'{100*s/total:.1f}' if total else ''
+            memoria = self.memoria_pico_mb.get(nombre)
+            memoria = '' if memoria is None else f'{memoria:.1f}'
+            lineas.append(f'{nombre:<28}{s:>12.3f}{porcentaje:>8}{self.llamadas[nombre]:>10}{memoria:>12}')
+        for nombre in sorted(self.contadores):
+            lineas.append(f'{nombre:<28}{self.contadores[nombre]:>12}')
+        if total is not None:
+            lineas.append(f'{"total":<28}{total:>12.3f}')
+            lineas.append(f'{"memoria máxima (MB)":<28}{self.memoria_max_mb:>12.1f}')
+        return '\n'.join(lineas)
+
+    def prometheus(self,prefijo:str='closest_point')->str:
+        '''
+        Las métricas en el formato de texto de Prometheus (para un textfile collector o un pushgateway)
+        '''
+        lineas = [f'# TYPE {prefijo}_etapa_segundos_total counter',
+                  *[f'{prefijo}_etapa_segundos_total{{etapa="{n}"}} {s}' for n,s in self.segundos.items()],
+                  f'# TYPE {prefijo}_etapa_llamadas_total counter',
+                  *[f'{prefijo}_etapa_llamadas_total{{etapa="{n}"}} {c}' for n,c in self.llamadas.items()]]
+        if self.memoria_pico_mb:
+            lineas += [f'# TYPE {prefijo}_etapa_memoria_pico_bytes gauge',
+                       *[f'{prefijo}_etapa_memoria_pico_bytes{{etapa="{n}"}} {int(m*2**20)}'
+                         for n,m in self.memoria_pico_mb.items()]]
+        for nombre, valor in self.contadores.items():
+            lineas += [f'# TYPE {prefijo}_{nombre}_total counter',f'{prefijo}_{nombre}_total {valor}']
+        if getattr(self,'memoria_max_mb',None) is not None:
+            lineas += [f'# TYPE {prefijo}_memoria_max_bytes gauge',f'{prefijo}_memoria_max_bytes {int(self.memoria_max_mb*2**20)}']
+        return '\n'.join(lineas)+'\n'
+
+
+@contextmanager
+def etapa(nombre:str):
+    '''
+    Mide el bloque como la etapa `nombre` en los colectores activos
+    (sin colectores activos no hace nada)
+    '''
+    if not _ACTIVAS:
+        yield
+        return
+    # El pico se reinicia al empezar cada etapa (en etapas anidadas la de afuera sólo ve el pico
+    # posterior a la última etapa interna)
+    memoria = tracemalloc.is_tracing() and any(m.memoria for m in _ACTIVAS) and hasattr(tracemalloc,'reset_peak')
+    if memoria:
+        tracemalloc.reset_peak()
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        segundos = time.perf_counter()-inicio
+        memoria_mb = tracemalloc.get_traced_memory()[1]/2**20 if memoria else None
+        for m in list(_ACTIVAS):
+            m.registra_etapa(nombre,segundos,memoria_mb)
+
+
+def cuenta(nombre:str,n=1):
+    '''
+    Suma n al contador `nombre` de los colectores activos
+    '''
+    for m in _ACTIVAS:
+        m.cuenta(nombre,n)
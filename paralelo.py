@@ -0,0 +1,116 @@
+import os
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from denue_store import DenueStore
+from denue_cache import carga_arrays
+
+
+# DenueStore de cada proceso del pool (se carga una sola vez por proceso, no por tarea)
+_STORE = None
+
+# Pools abiertos por (directorio del cache o store, n_jobs); siguen vivos entre llamadas para que
+# los procesos conserven el store y sus KD-trees (ver close)
+_POOLS = {}
+
+
+def _inicializa(directorio:str,store:DenueStore):
+    '''
+    Inicializador de cada proceso: abre el cache en disco (memory-mapped, las páginas se
+    comparten entre procesos) o recibe el store una sola vez
+    '''
+    global _STORE
+    if directorio is not None:
+        _, arrays = carga_arrays(directorio)
+        _STORE = DenueStore.desde_arrays(arrays)
+    elif store is not None:
+        _STORE = store
+
+
+def _tarea(codigo:str,lat,lon,metros,k,motor,memoria_mb,metrica):
+    return _STORE.consulta_multiple(codigo,lat,lon,metros,k=k,motor=motor,memoria_mb=memoria_mb,metrica=metrica)
+
+
+def consulta_paralela(store:DenueStore,codigos:list,lat,lon,metros=2000,k=1,n_jobs=-1,bloque_puntos=None,motor='kdtree',memoria_mb=256,metrica='haversine')->dict:
+    '''
+    Reparte las consultas en un pool de procesos por código de actividad y por bloques de puntos
+    y junta los resultados en el mismo orden en que se pidieron. El pool se queda abierto para las
+    siguientes llamadas con el mismo store (p.ej. los bloques de flujo_manzanas), así los procesos
+    no vuelven a abrir el cache ni a construir los KD-trees; paralelo.close() lo cierra.
+    ----------
+    Inputs:
+            - store: DenueStore, de preferencia leído del cache en disco (ver denue_cache.cargar_denue)
+            - codigos: list, códigos de actividad
+            - lat: array, latitudes
+            - lon: array, longitudes
+            - metros: float o list, metros a buscar
+            - k: int, número de unidades más cercanas
+            - n_jobs: int, número de procesos (-1 usa todos los cores)
+            - bloque_puntos: int, puntos por tarea; por omisión reparte los puntos entre n_jobs
+            - motor, memoria_mb, metrica: ver DenueIndex.consulta
+    Outputs:
+            - dict, codigo: (numero, distancia) como en DenueIndex.consulta_multiple
+    '''
+    if len(lat)==0:
+        return {codigo:(np.zeros((0,np.size(metros)),dtype=int),np.zeros((0,k))) for codigo in codigos}
+    if n_jobs is None or n_jobs<0:
+        n_jobs = os.cpu_count()
+    if bloque_puntos is None:
+        bloque_puntos = max(1,int(np.ceil(len(lat)/n_jobs)))
+    inicios = range(0,len(lat),bloque_puntos)
+
+    pool = _pool(store,n_jobs)
+    try:
+        futuros = {(codigo,i):pool.submit(_tarea,codigo,lat[i:i+bloque_puntos],lon[i:i+bloque_puntos],metros,k,motor,memoria_mb,metrica)
+                   for codigo in codigos for i in inicios}
+        resultados = {}
+        for codigo in codigos:
+            partes = [futuros[(codigo,i)].result() for i in inicios]
+            resultados[codigo] = (np.concatenate([p[0] for p in partes]),np.concatenate([p[1] for p in partes]))
+    except BrokenProcessPool:
+        # Si murió un proceso el pool ya no sirve; la siguiente llamada abre otro
+        close(store)
+        raise
+    return resultados
+
+
+def _clave(store:DenueStore,n_jobs:int)->tuple:
+    directorio = getattr(store,'directorio',None)
+    return (directorio if directorio is not None else id(store),n_jobs)
+
+
+def _pool(store:DenueStore,n_jobs:int)->ProcessPoolExecutor:
+    '''
+    Pool de procesos del store, se abre la primera vez y se reutiliza en las llamadas siguientes
+    '''
+    clave = _clave(store,n_jobs)
+    if clave not in _POOLS:
+        # Los procesos abren el cache por su cuenta; si el store no viene del cache lo heredan con
+        # fork (copy-on-write) o, si no hay fork, lo reciben una vez en el inicializador
+        directorio = getattr(store,'directorio',None)
+        if directorio is not None:
+            contexto, initargs = multiprocessing.get_context(), (directorio,None)
+        elif 'fork' in multiprocessing.get_all_start_methods():
+            contexto, initargs = multiprocessing.get_context('fork'), (None,store)
+        else:
+            contexto, initargs = multiprocessing.get_context(), (None,store)
+        pool = ProcessPoolExecutor(max_workers=n_jobs,mp_context=contexto,initializer=_inicializa,initargs=initargs)
+        # Guardamos el store con el pool para que su id no se reutilice mientras el pool exista
+        _POOLS[clave] = (pool,store)
+    return _POOLS[clave][0]
+
+
+def close(store:DenueStore=None):
+    '''
+    Cierra los pools del store (o todos si no se da) y sus procesos
+    '''
+    for clave in list(_POOLS):
+        pool, de = _POOLS[clave]
+        if store is None or de is store or clave[0]==getattr(store,'directorio',None):
+            del _POOLS[clave]
+            pool.shutdown(wait=True)
+
+
+atexit.register(close)
@@ -1,42 +1,18 @@
-import numpy as np
-import requests # Para acceder a la API de Google
-import re # Para usar regular expressions
-import geopandas as gpd # Para leer y manipular shapefiles
-from shapely.geometry import Point # Para crear un punto con latitud y longitud
 import yaml # Para leer datos como keys y paths
-import matplotlib.pyplot as plt 
 import pandas as pd
 from closest_point import RadiousUnidadesEconomicas
+from denue_cache import cargar_denue, cargar_manzanas
+from flujo_manzanas import procesa_manzanas
+from metricas import Metricas
 import time
 
-# Cargamos el shapefile
+# Cargamos CVEGEO y centroide de las manzanas (del cache en disco, ver denue_cache.py)
 estado = 9
+# True procesa todas las manzanas del estado por bloques (ver flujo_manzanas.py) en vez de la muestra
+todas_las_manzanas = False
 with open('estado_shapefile.yaml') as f: 
     path = yaml.load(f,Loader=yaml.FullLoader)
-    path = path[f'shp_mza_{estado}']
-shp_mza = gpd.read_file(path)
-# Cambiamos el crs
-shp_mza.to_crs('EPSG:4326',inplace=True)
-# Filtramos por municipio
-# mun = '050'
-# shp_mza = shp_mza[shp_mza['CVE_MUN']==mun]
-
-start = time.time()
-# Tomamos n_sample manzanas al azar
-n_samples = 200
-shp_mza = shp_mza.sample(n_samples,random_state=12345).reset_index(drop=True)
-# Calculamos el centroide
-shp_mza['centroid'] = shp_mza.centroid
-# Guardamos las coordenadas
-latitud = []
-longitud = []
-for p in shp_mza['centroid']:
-    latitud.append(p.y)
-    longitud.append(p.x)
-points = pd.DataFrame({'CVEGEO':shp_mza['CVEGEO'],'latitud':latitud,'longitud':longitud})
-
-end = time.time()
-print('Simulation running time: {:.2f} minutes'.format((end-start)/60))
+    path_shp_mza = path[f'shp_mza_{estado}']
 
 # Definimos las unidades economicas con un diccionario
 # unidades_economicas = {'supermercados':'462111','minisupers':'462112','vinos_licores':'461211',
@@ -49,32 +25,68 @@ unidades_economicas = {'522110':'bancos','primarias_privadas':'611121','611131':
                        '464121':'lentes_minoreo','622111':'hospitales_privados','512130':'cines',
                        '722511':'restaurantes','722515':'cafeterias','721111':'hoteles'}
 
-# Creamos el data frame a imprimir 
-df = pd.DataFrame()
-df['CVEGEO'] = points['CVEGEO']
-df['latitud'] = points['latitud']
-df['longitud'] = points['longitud']
+# Tiempos por etapa, contadores y memoria de la corrida (ver metricas.py)
+metricas = Metricas()
+with metricas:
+    # Leemos el shapefile del DENUE
+    with open("denue_shapefile.yaml") as f: 
+            path = yaml.load(f,Loader=yaml.FullLoader)
+    path_shp_denue = path[f'denue_{estado}']
+    # Cargamos el DENUE del cache en disco (se reconstruye si cambió el shapefile)
+    denue = cargar_denue(path_shp_denue,clave=f'denue_{estado}')
+
+    # Radios (un conteo por radio) y número de unidades más cercanas, todo en una sola pasada
+    metros = [500,1000,2000]
+    k = 3
+
+    if todas_las_manzanas:
+        # Leemos, evaluamos y escribimos por bloques con checkpoint (si se interrumpe, continúa
+        # donde se quedó al volver a correr)
+        start = time.time()
+        resumen = procesa_manzanas(path_shp_mza=path_shp_mza,path_shp_denue=denue,
+                                   codigo_act_dict=unidades_economicas,salida=f'casas_{estado}.csv',
+                                   metros=metros,k=k,
+                                   progreso=lambda bloque,filas: print(f'Bloque {bloque}: {filas} manzanas'))
+        end = time.time()
+        print('Features running time: {:.2f} minutes ({} manzanas)'.format((end-start)/60,resumen['filas']))
+    else:
+        shp_mza = cargar_manzanas(path_shp_mza,clave=f'shp_mza_{estado}')
+        # Filtramos por municipio
+        # mun = '050'
+        # shp_mza = shp_mza[shp_mza['CVEGEO'].str[2:5]==mun]
+
+        start = time.time()
+        # Tomamos n_sample manzanas al azar
+        n_samples = 200
+        points = shp_mza.sample(n_samples,random_state=12345).reset_index(drop=True)
+
+        end = time.time()
+        print('Simulation running time: {:.2f} minutes'.format((end-start)/60))
 
-# Leemos el shapefile del DENUE
-with open("denue_shapefile.yaml") as f: 
-        path = yaml.load(f,Loader=yaml.FullLoader)
-path_shp_denue = path[f'denue_{estado}']
+        # Creamos el data frame a imprimir 
+        df = pd.DataFrame()
+        df['CVEGEO'] = points['CVEGEO']
+        df['latitud'] = points['latitud']
+        df['longitud'] = points['longitud']
 
-lat = df['latitud']
-lon = df['longitud']
-metros = 1000
+        lat = df['latitud']
+        lon = df['longitud']
 
-# Creamos los fetures de número de unidades y distancia 
-start = time.time()
-rue = RadiousUnidadesEconomicas(path_shp_denue=path_shp_denue,
-                                codigo_act_dict=unidades_economicas,
-                                lat=lat,lon=lon,
-                                metros=metros)
-end = time.time()
-print('Features running time: {:.2f} minutes'.format((end-start)/60))
+        # Creamos los fetures de número de unidades y distancia 
+        start = time.time()
+        rue = RadiousUnidadesEconomicas(path_shp_denue=denue,
+                                        codigo_act_dict=unidades_economicas,
+                                        lat=lat,lon=lon,
+                                        metros=metros,k=k)
+        end = time.time()
+        print('Features running time: {:.2f} minutes'.format((end-start)/60))
 
-df = pd.concat([df,rue],axis=1)
+        df = pd.concat([df,rue],axis=1)
 
-# Exportamos el csv
-df.to_csv('casas_sample.csv',index=False)
+        # Exportamos el csv
+        df.to_csv('casas_sample.csv',index=False)
 
+# Resumen de la corrida y el mismo reporte en formato de Prometheus
+print(metricas.resumen())
+with open(f'metricas_{estado}.prom','w') as f:
+    f.write(metricas.prometheus())
@@ -0,0 +1,220 @@
+import json
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from closest_point import RadiousUnidadesEconomicas
+from denue_cache import cargar_denue
+from denue_index import a_arreglo
+from distancias import Metrica
+from metricas import Metricas, etapa, cuenta
+
+
+class MicroLotes:
+    '''
+    Junta las consultas que llegan al mismo tiempo en una sola llamada vectorizada. Un hilo
+    toma la primera consulta de la cola, espera hasta espera_ms (o hasta max_puntos) por más,
+    agrupa las que piden lo mismo (estado, códigos, radios, k, métrica) y las resuelve con una
+    llamada a RadiousUnidadesEconomicas por grupo. Como un solo hilo consulta los índices, los
+    KD-trees se construyen y usan sin locks.
+    ----------
+    Inputs:
+            - stores: dict, estado: DenueStore (o DenueNacional) ya cargado
+            - grids: dict, estado: GridDensidad (opcional, ver grid_density)
+            - espera_ms: float, tiempo máximo que una consulta espera a otras
+            - max_puntos: int, puntos máximos por lote
+    '''
+
+    def __init__(self,stores:dict,grids:dict=None,espera_ms:float=5,max_puntos:int=10000):
+        self.stores = stores
+        self.grids = grids or {}
+        self.espera = espera_ms/1000
+        self.max_puntos = max_puntos
+        self.lotes = 0
+        self.consultas = 0
+        self._cola = queue.Queue()
+        self._hilo = threading.Thread(target=self._trabaja,daemon=True)
+        self._hilo.start()
+
+    def envia(self,estado:str,codigo_act_dict:dict,lat,lon,metros=2000,k:int=1,metrica:str='haversine')->Future:
+        '''
+        Encola una consulta y devuelve un Future con su DataFrame (mismas columnas que RadiousUnidadesEconomicas)
+        '''
+        if estado not in self.stores:
+            raise KeyError(f'estado {estado!r} no está cargado, hay {list(self.stores)}')
+        # Validamos aquí para que una consulta mal formada no llegue al hilo de los lotes
+        if not isinstance(codigo_act_dict,dict) or not all(isinstance(c,str) and isinstance(n,str)
+                                                           for c,n in codigo_act_dict.items()):
+            raise TypeError('codigo_act_dict debe ser un dict código: nombre (strings)')
+        if metrica not in Metrica.TIPOS:
+            raise ValueError(f'metrica debe ser una de {Metrica.TIPOS}, no {metrica!r}')
+        if isinstance(k,bool) or not isinstance(k,(int,np.integer)) or k<1:
+            raise ValueError(f'k debe ser un entero positivo, no {k!r}')
+        lat = a_arreglo(lat)
+        lon = a_arreglo(lon)
+        if len(lat)!=len(lon):
+            raise ValueError('lat y lon deben tener el mismo tamaño')
+        metros = float(metros) if np.ndim(metros)==0 else tuple(float(m) for m in metros)
+        clave = (estado,tuple(codigo_act_dict.items()),metros,int(k),metrica)
+        futuro = Future()
+        self._cola.put((clave,lat,lon,futuro))
+        return futuro
+
+    def close(self):
+        self._cola.put(None)
+        self._hilo.join()
+
+    def _trabaja(self):
+        while True:
+            primero = self._cola.get()
+            if primero is None:
+                return
+            # Esperamos un poco a otras consultas para resolverlas juntas
+            pendientes, n = [primero], len(primero[1])
+            limite = time.monotonic()+self.espera
+            while n<self.max_puntos:
+                restante = limite-time.monotonic()
+                if restante<=0:
+                    break
+                try:
+                    siguiente = self._cola.get(timeout=restante)
+                except queue.Empty:
+                    break
+                if siguiente is None:
+                    self._cola.put(None)
+                    break
+                pendientes.append(siguiente)
+                n += len(siguiente[1])
+
+            grupos = {}
+            for consulta in pendientes:
+                grupos.setdefault(consulta[0],[]).append(consulta)
+            for clave, consultas in grupos.items():
+                self._resuelve(clave,consultas)
+
+    def _resuelve(self,clave:tuple,consultas:list):
+        estado, codigos, metros, k, metrica = clave
+        metros = list(metros) if isinstance(metros,tuple) else metros
+        tamanos = [len(c[1]) for c in consultas]
+        try:
+            with etapa('lote'):
+                df = RadiousUnidadesEconomicas(path_shp_denue=self.stores[estado],codigo_act_dict=dict(codigos),
+                                               lat=np.concatenate([c[1] for c in consultas]),
+                                               lon=np.concatenate([c[2] for c in consultas]),
+                                               metros=metros,k=k,metrica=metrica,grid=self.grids.get(estado))
+        except Exception as e:
+            for c in consultas:
+                c[3].set_exception(e)
+            return
+        self.lotes += 1
+        self.consultas += len(consultas)
+        cuenta('lotes')
+        cuenta('consultas',len(consultas))
+        inicio = 0
+        for c, n in zip(consultas,tamanos):
+            c[3].set_result(df.iloc[inicio:inicio+n].reset_index(drop=True))
+            inicio += n
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        if self.path=='/salud':
+            return self._responde(200,{'estados':list(server.lotes.stores),'lotes':server.lotes.lotes,
+                                       'consultas':server.lotes.consultas})
+        if self.path=='/metricas':
+            datos = server.metricas.prometheus().encode('utf-8')
+            return self._envia(200,datos,'text/plain; version=0.0.4')
+        self._responde(404,{'error':'no existe'})
+
+    def do_POST(self):
+        # POST /consulta con un json: estado, codigo_act_dict, lat, lon y opcionalmente metros, k, metrica
+        if self.path!='/consulta':
+            return self._responde(404,{'error':'no existe'})
+        try:
+            largo = int(self.headers.get('Content-Length',0))
+            q = json.loads(self.rfile.read(largo))
+            futuro = self.server.lotes.envia(q['estado'],q['codigo_act_dict'],q['lat'],q['lon'],
+                                             metros=q.get('metros',2000),k=q.get('k',1),
+                                             metrica=q.get('metrica','haversine'))
+        except (KeyError,ValueError,TypeError) as e:
+            return self._responde(400,{'error':str(e)})
+        try:
+            df = futuro.result(timeout=self.server.timeout_s)
+        except Exception as e:
+            return self._responde(500,{'error':repr(e)})
+        # Mismo formato que DataFrame.to_json(orient='split') (los NaN se mandan como null)
+        self._envia(200,df.to_json(orient='split',index=False).encode('utf-8'),'application/json')
+
+    def _responde(self,codigo:int,cuerpo:dict):
+        self._envia(codigo,json.dumps(cuerpo).encode('utf-8'),'application/json')
+
+    def _envia(self,codigo:int,datos:bytes,tipo:str):
+        self.send_response(codigo)
+        self.send_header('Content-Type',tipo)
+        self.send_header('Content-Length',str(len(datos)))
+        self.end_headers()
+        self.wfile.write(datos)
+
+    def log_message(self,*args):
+        pass
+
+
+def inicia_servidor(stores:dict,puerto:int=0,grids:dict=None,espera_ms:float=5,max_puntos:int=10000,
+                    timeout_s:float=60,host:str='127.0.0.1',calentar:list=(),metrica:str='haversine'):
+    '''
+    Levanta en un hilo el servidor de consultas con los DENUE ya cargados en memoria
+    ----------
+    Inputs:
+            - stores: dict, estado (p.ej. 'denue_31'): DenueStore
+            - puerto: int, puerto local (0 elige uno libre)
+            - grids, espera_ms, max_puntos: ver MicroLotes
+            - timeout_s: float, segundos máximos que una solicitud espera su resultado
+            - host: str, interfaz donde escucha
+            - calentar: list, códigos cuyos KD-trees se construyen antes de recibir consultas
+            - metrica: str, métrica de los árboles que se calientan
+    Outputs:
+            - (server, url): el servidor (server.shutdown() lo detiene) y la url base; las rutas
+              son POST /consulta, GET /salud y GET /metricas (formato de Prometheus)
+    '''
+    for store in stores.values():
+        for codigo in calentar:
+            if hasattr(store,'indice'):
+                store.indice.arbol(codigo,metrica)
+
+    server = ThreadingHTTPServer((host,puerto),_Handler)
+    server.daemon_threads = True
+    server.timeout_s = timeout_s
+    server.lotes = MicroLotes(stores,grids=grids,espera_ms=espera_ms,max_puntos=max_puntos)
+    # Las métricas del servidor se acumulan durante toda su vida
+    server.metricas = Metricas().__enter__()
+
+    def sirve():
+        try:
+            server.serve_forever()
+        finally:
+            server.lotes.close()
+            server.metricas.__exit__(None,None,None)
+    threading.Thread(target=sirve,daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+
+if __name__=='__main__':
+    import yaml # Para leer datos como keys y paths
+
+    # Cargamos (y calentamos) los DENUE de todos los estados del yaml una sola vez
+    with open("denue_shapefile.yaml") as f:
+        path = yaml.load(f,Loader=yaml.FullLoader)
+    stores = {clave:cargar_denue(path_shp_denue,clave=clave) for clave,path_shp_denue in path.items()}
+
+    codigos = ['522110','611121','611131','462111','463310','463211',
+               '464121','622111','512130','722511','722515','721111']
+    server, url = inicia_servidor(stores,puerto=8080,calentar=codigos)
+    print(f'Servidor de consultas en {url}/consulta')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,128 @@
+import os
+import sys
+import random
+from collections import Counter
+import numpy as np
+import pytest
+
+# Los módulos del proyecto viven en la raíz del repositorio
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,RAIZ)
+
+from google_client import DistanceMatrixClient, DistanceMatrixError, empaqueta, MAX_ELEMENTOS, MAX_DIMENSION
+from distance_matrix_stub import inicia_stub, RADIO_TIERRA, VELOCIDAD_KMH
+from metricas import Metricas
+
+
+class ClienteRegistrado(DistanceMatrixClient):
+    '''
+    DistanceMatrixClient que anota los orígenes y destinos de cada solicitud (una vez por
+    solicitud, sin contar los reintentos)
+    '''
+
+    def __init__(self,*args,**kwargs):
+        super().__init__(*args,**kwargs)
+        self.enviadas = []
+
+    def _solicitud(self,origenes:list,destinos:list)->np.ndarray:
+        with self._lock:
+            self.enviadas.append((list(origenes),list(destinos)))
+        return super()._solicitud(origenes,destinos)
+
+
+def consultas(n_origenes:int=60,n_destinos:int=80,semilla:int=7):
+    '''
+    Orígenes y destinos alrededor de Mérida: cada origen pide entre 1 y 60 destinos de un mismo
+    conjunto y los orígenes vecinos (de tres en tres) piden los mismos, así hay solicitudes con
+    varios orígenes, destinos compartidos entre solicitudes y orígenes con más de 25 destinos
+    (varios bloques)
+    '''
+    rng = np.random.default_rng(semilla)
+    puntos = [(round(21+rng.normal(0,.05),6),round(-89.6+rng.normal(0,.05),6)) for _ in range(n_destinos)]
+    origenes = [(round(21+rng.normal(0,.05),6),round(-89.6+rng.normal(0,.05),6)) for _ in range(n_origenes)]
+    grupos = [[puntos[j] for j in rng.choice(n_destinos,size=rng.integers(1,61),replace=False)]
+              for _ in range(0,n_origenes,3)]
+    return origenes, [grupos[i//3] for i in range(n_origenes)]
+
+
+def minutos_esperados(origen:tuple,destinos:list)->np.ndarray:
+    # La misma duración que calcula el stub: haversine a VELOCIDAD_KMH redondeada a segundos
+    o = np.radians(origen)
+    d = np.radians(np.array(destinos))
+    a = np.sin((d[:,0]-o[0])/2)**2+np.cos(o[0])*np.cos(d[:,0])*np.sin((d[:,1]-o[1])/2)**2
+    metros = 2*RADIO_TIERRA*np.arcsin(np.sqrt(a))
+    return np.round(metros/(VELOCIDAD_KMH/3.6))/60
+
+
+@pytest.fixture
+def stub_con_errores():
+    random.seed(12345)
+    server, url = inicia_stub(tasa_error=0.3)
+    yield server, url
+    server.shutdown()
+
+
+def test_empaqueta_cubre_cada_par_una_vez():
+    _, destinos_por_origen = consultas()
+    solicitudes = empaqueta(destinos_por_origen)
+
+    pares = Counter(p for _,_,pares_s in solicitudes for p in pares_s)
+    esperados = {(i,d) for i,destinos in enumerate(destinos_por_origen) for d in destinos}
+    assert set(pares)==esperados
+    assert max(pares.values())==1
+    for origenes, destinos, pares_s in solicitudes:
+        assert len(origenes)<=MAX_DIMENSION and len(destinos)<=MAX_DIMENSION
+        assert len(origenes)*len(destinos)<=MAX_ELEMENTOS
+        assert all(i in origenes and d in destinos for i,d in pares_s)
+    # Al menos una solicitud junta varios orígenes
+    assert max(len(origenes) for origenes,_,_ in solicitudes)>1
+
+
+def test_cliente_contra_stub_con_errores(stub_con_errores):
+    server, url = stub_con_errores
+    origenes, destinos_por_origen = consultas()
+    solicitudes = empaqueta(destinos_por_origen)
+
+    with Metricas() as m, ClienteRegistrado(url=url,hilos=4,max_reintentos=30,backoff=0.001) as client:
+        resultado = client.duraciones(origenes,destinos_por_origen)
+
+    # Las duraciones de todos los pares, en el orden en que se pidieron
+    assert len(resultado)==len(origenes)
+    for origen, destinos, minutos in zip(origenes,destinos_por_origen,resultado):
+        np.testing.assert_allclose(minutos,minutos_esperados(origen,destinos),atol=1e-9)
+
+    # Una solicitud por paquete de empaqueta, todas dentro de los límites de la API (el stub
+    # además rechaza las que los pasan)
+    assert len(client.enviadas)==len(solicitudes)
+    for origenes_s, destinos_s in client.enviadas:
+        assert len(origenes_s)<=MAX_DIMENSION and len(destinos_s)<=MAX_DIMENSION
+        assert len(origenes_s)*len(destinos_s)<=MAX_ELEMENTOS
+    assert server.elementos==sum(len(o)*len(d) for o,d,_ in solicitudes)
+
+    # Los OVER_QUERY_LIMIT del stub se reintentaron
+    reintentos = m.contadores.get('api_reintentos',0)
+    assert reintentos>0
+    assert client.solicitudes==server.solicitudes==len(solicitudes)+reintentos
+
+
+def test_cliente_sin_errores_no_reintenta():
+    server, url = inicia_stub()
+    origenes, destinos_por_origen = consultas(n_origenes=20,semilla=3)
+    try:
+        with Metricas() as m, DistanceMatrixClient(url=url,hilos=4) as client:
+            client.duraciones(origenes,destinos_por_origen)
+    finally:
+        server.shutdown()
+    assert client.solicitudes==server.solicitudes==len(empaqueta(destinos_por_origen))
+    assert 'api_reintentos' not in m.contadores
+
+
+def test_cliente_agota_reintentos():
+    server, url = inicia_stub(tasa_error=1)
+    try:
+        with DistanceMatrixClient(url=url,max_reintentos=2,backoff=0.001) as client:
+            with pytest.raises(DistanceMatrixError):
+                client.duraciones([(21,-89.6)],[[(21.01,-89.61)]])
+    finally:
+        server.shutdown()
+    assert client.solicitudes==server.solicitudes==3
@@ -0,0 +1,124 @@
+import os
+import time
+import sqlite3
+import threading
+import numpy as np
+import geohash
+
+
+class CacheDuraciones:
+    '''
+    Cache en disco (SQLite) de duraciones de viaje. La llave es la celda geohash del origen
+    (así orígenes cercanos comparten resultados), el id de la unidad del DENUE destino y el modo.
+    Las entradas caducan después de ttl_dias y, si hay más de max_entradas, se borran las
+    usadas hace más tiempo (LRU). Lleva la cuenta de aciertos y fallos.
+    ----------
+    Inputs:
+            - path: str, archivo SQLite; por omisión duraciones.sqlite en el directorio del cache
+              del DENUE (variable de ambiente DENUE_CACHE_DIR, ver denue_cache.CACHE_DIR)
+            - precision: int, caracteres del geohash del origen (7 ~ 150 m, 6 ~ 1 km)
+            - ttl_dias: float, días que una duración es válida (None no caduca)
+            - max_entradas: int, tamaño máximo del cache (None no tiene límite)
+    '''
+
+    PURGA_CADA = 10000
+
+    def __init__(self,path:str=None,precision:int=7,ttl_dias:float=30,max_entradas:int=5_000_000):
+        if path is None:
+            path = os.path.join(os.environ.get('DENUE_CACHE_DIR','cache'),'duraciones.sqlite')
+        self.path = path
+        self.precision = precision
+        self.ttl = None if ttl_dias is None else ttl_dias*24*3600
+        self.max_entradas = max_entradas
+        self.aciertos = 0
+        self.fallos = 0
+        self._insertados = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path),exist_ok=True)
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(path,check_same_thread=False)
+        self._con.execute('PRAGMA journal_mode=WAL')
+        self._con.execute('''CREATE TABLE IF NOT EXISTS duraciones (
+                                 celda TEXT, destino TEXT, modo TEXT, minutos REAL, creado REAL, usado REAL,
+                                 PRIMARY KEY (celda,destino,modo)) WITHOUT ROWID''')
+        self._con.execute('CREATE INDEX IF NOT EXISTS duraciones_usado ON duraciones (usado)')
+        self._con.commit()
+
+    def close(self):
+        with self._lock:
+            self._purga()
+        self._con.close()
+
+    def celda(self,lat:float,lon:float)->str:
+        return geohash.codifica(lat,lon,self.precision)
+
+    def obtiene(self,lat:float,lon:float,destinos:list,modo:str='driving'):
+        '''
+        Busca las duraciones del origen a los destinos
+        ----------
+        Inputs:
+                - lat, lon: float, origen
+                - destinos: list, ids de las unidades destino
+                - modo: str, modo de transporte
+        Outputs:
+                - (minutos, encontrado): arrays con la duración (NaN si no hay ruta) y si estaba en el cache
+        '''
+        destinos = [str(d) for d in destinos]
+        celda = self.celda(lat,lon)
+        ahora = time.time()
+        minimo = 0 if self.ttl is None else ahora-self.ttl
+
+        filas = {}
+        with self._lock:
+            for i in range(0,len(destinos),500):
+                bloque = destinos[i:i+500]
+                marcas = ','.join('?'*len(bloque))
+                filas.update(self._con.execute(
+                    f'SELECT destino, minutos FROM duraciones WHERE celda=? AND modo=? AND creado>=? AND destino IN ({marcas})',
+                    [celda,modo,minimo]+bloque).fetchall())
+            if filas:
+                # Actualizamos la fecha de uso para el LRU
+                self._con.executemany('UPDATE duraciones SET usado=? WHERE celda=? AND destino=? AND modo=?',
+                                      [(ahora,celda,d,modo) for d in filas])
+                self._con.commit()
+            self.aciertos += len(filas)
+            self.fallos += len(destinos)-len(filas)
+
+        encontrado = np.array([d in filas for d in destinos],dtype=bool)
+        minutos = np.array([np.nan if filas.get(d) is None else filas[d] for d in destinos],dtype=float)
+        return minutos, encontrado
+
+    def guarda(self,lat:float,lon:float,destinos:list,minutos,modo:str='driving'):
+        '''
+        Guarda las duraciones del origen a los destinos (NaN se guarda como "sin ruta")
+        '''
+        celda = self.celda(lat,lon)
+        ahora = time.time()
+        filas = [(celda,str(d),modo,None if np.isnan(m) else float(m),ahora,ahora) for d,m in zip(destinos,minutos)]
+        with self._lock:
+            self._con.executemany('INSERT OR REPLACE INTO duraciones VALUES (?,?,?,?,?,?)',filas)
+            self._con.commit()
+            # Purgamos cada PURGA_CADA inserciones para no contar la tabla en cada escritura
+            self._insertados += len(filas)
+            if self._insertados>=self.PURGA_CADA:
+                self._purga()
+                self._insertados = 0
+
+    def _purga(self):
+        # Borramos lo caducado y, si aún sobran entradas, las menos usadas recientemente
+        if self.ttl is not None:
+            self._con.execute('DELETE FROM duraciones WHERE creado<?',(time.time()-self.ttl,))
+        if self.max_entradas is not None:
+            n = self._con.execute('SELECT COUNT(*) FROM duraciones').fetchone()[0]
+            if n>self.max_entradas:
+                self._con.execute('''DELETE FROM duraciones WHERE (celda,destino,modo) IN
+                                     (SELECT celda,destino,modo FROM duraciones ORDER BY usado LIMIT ?)''',(n-self.max_entradas,))
+        self._con.commit()
+
+    def estadisticas(self)->dict:
+        with self._lock:
+            n = self._con.execute('SELECT COUNT(*) FROM duraciones').fetchone()[0]
+        total = self.aciertos+self.fallos
+        return {'entradas':n,'aciertos':self.aciertos,'fallos':self.fallos,
+                'tasa_aciertos':self.aciertos/total if total else np.nan}